@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options]
+
+Record --playlists playlists from a local fake Last.fm server (see
+fakelastfm.py) with RadioClient.loop and report tracks per minute, MB/s,
+CPU seconds per MB and peak RSS of each recording engine. The client runs
+in a child process so that the server doesn't count towards its CPU time
+and memory.
+'''
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from fakelastfm import add_server_options, client_urls, make_server
+
+MB = 1024 * 1024
+ENGINES = ['thread', 'event']
+STATION = 'lastfm://globaltags/benchmark'
+
+
+class Finished(Exception):
+    pass
+
+
+def make_client(engine, jobs, outdir, server_address, playlists):
+    '''RadioClient of `engine` recording from fake server at
+    `server_address` that stops after `playlists` playlists
+    '''
+    if engine == 'event':
+        from lastrecorder.asyncradio import AsyncRadioClient as cls
+    else:
+        from lastrecorder.radio import RadioClient as cls
+    client = cls('benchmark', '0' * 32, outdir, jobs=jobs)
+    server = type('Address', (object,), dict(server_address=server_address))
+    for name, value in client_urls(server).items():
+        setattr(client, name, value)
+    next_tracks = client.next_tracks
+    fetched = [0]
+    def limited_next_tracks(*args, **kw):
+        if fetched[0] >= playlists:
+            raise Finished
+        fetched[0] += 1
+        return next_tracks(*args, **kw)
+    client.next_tracks = limited_next_tracks
+    client.results = dict(recorded=0, skipped=0, failed=0)
+    def count(result):
+        def callback(track):
+            client.results[result] += 1
+        return callback
+    client.track_end_cb = count('recorded')
+    client.track_skip_cb = count('skipped')
+    client.track_error_cb = count('failed')
+    return client
+
+
+def saved_bytes(outdir):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(outdir):
+        total += sum([ os.path.getsize(os.path.join(dirpath, name))
+                       for name in filenames if not name.startswith('.') ])
+    return total
+
+
+def child(options):
+    '''Record in this process and print results as JSON
+    '''
+    # Track names mix byte and unicode strings, as in lastrecorder.main
+    reload(sys).setdefaultencoding('utf-8')
+    logging.basicConfig(level=options.verbose and logging.INFO or
+                        logging.CRITICAL)
+    host, port = options.child.split(':')
+    outdir = tempfile.mkdtemp(prefix='lastrecorder-e2e.')
+    try:
+        client = make_client(options.engine, options.jobs, outdir,
+                             (host, int(port)), options.playlists)
+        start = time.time()
+        try:
+            client.loop([STATION])
+        except Finished:
+            pass
+        wall = time.time() - start
+        size = saved_bytes(outdir)
+    finally:
+        shutil.rmtree(outdir, True)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results = dict(client.results, wall=wall, bytes=size,
+                   cpu=usage.ru_utime + usage.ru_stime,
+                   # Kilobytes on Linux
+                   maxrss=usage.ru_maxrss * 1024)
+    print json.dumps(results)
+
+
+def run(engine, server, options):
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', '%s:%d' % server.server_address,
+               '--engine', engine, '--jobs', str(options.jobs),
+               '--playlists', str(options.playlists)]
+    if options.verbose:
+        command.append('--verbose')
+    output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--engine', '-e', dest='engines', action='append',
+                      choices=ENGINES,
+                      help='engine to run, thread or event [default: both]')
+    parser.add_option('--jobs', '-j', dest='jobs', type='int', default=1,
+                      help='tracks to record at once [default: %default]')
+    parser.add_option('--playlists', '-n', dest='playlists', type='int',
+                      default=3,
+                      help='playlists to record [default: %default]')
+    parser.add_option('--verbose', '-v', dest='verbose', action='store_true',
+                      help='show client log')
+    parser.add_option('--child', dest='child', help=SUPPRESS_HELP)
+    add_server_options(parser)
+    options, args = parser.parse_args()
+    if options.child:
+        options.engine = options.engines[0]
+        child(options)
+        return
+
+    server = make_server(options)
+    server.start()
+    print ('%d playlists of %d tracks of %d KiB, %d jobs' %
+           (options.playlists, options.tracks, options.track_size,
+            options.jobs))
+    print '%-7s %8s %6s %10s %8s %9s %9s' % (
+        'engine', 'recorded', 'failed', 'tracks/min', 'MB/s', 'CPU s/MB',
+        'RSS MiB')
+    for engine in options.engines or ENGINES:
+        r = run(engine, server, options)
+        mb = r['bytes'] / float(MB)
+        print '%-7s %8d %6d %10.1f %8.2f %9.4f %9.1f' % (
+            engine, r['recorded'], r['failed'] + r['skipped'],
+            r['recorded'] * 60 / r['wall'], mb / r['wall'],
+            r['cpu'] / max(mb, 1e-6), r['maxrss'] / float(MB))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options]
+
+Local stand-in for the Last.fm radio service. Serves handshake.php,
+adjust.php and xspf.php under /radio and MP3 streams of silent frames
+under /stream, with configurable latency, per stream bandwidth, share of
+503 responses and share of streams cut off in the middle. Streams support
+Range requests so interrupted tracks can be resumed.
+
+Point a client at it with client_urls().
+'''
+from __future__ import with_statement
+import BaseHTTPServer
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+from optparse import OptionParser
+
+# MPEG 1 Layer III, 128 kbit/s, 44100 Hz frame of silence
+FRAME = '\xff\xfb\x90\x64' + '\x00' * 413
+CHUNK_SIZE = 16 * 1024
+# Any CHUNK_SIZE bytes of stream starting at a frame offset
+FRAMES = FRAME * (CHUNK_SIZE // len(FRAME) + 2)
+
+PLAYLIST = '''<?xml version="1.0" encoding="UTF-8"?>
+<playlist version="1" xmlns:lastfm="http://www.audioscrobbler.net/dtd/xspf-lastfm">
+  <title>Fake+Station</title>
+  <trackList>
+%s  </trackList>
+</playlist>
+'''
+TRACK = '''    <track>
+      <location>http://%(host)s/stream/%(playlist)d/%(i)d.mp3</location>
+      <title>Track %(playlist)d.%(i)d</title>
+      <album>Album %(playlist)d</album>
+      <creator>Artist %(i)d</creator>
+      <duration>240000</duration>
+    </track>
+'''
+
+
+def client_urls(server):
+    '''Returns RadioClient URL attributes pointing to `server`
+    '''
+    base_url = 'http://%s:%d/radio' % server.server_address
+    return dict(base_url=base_url,
+                handshake_url=(base_url + '/handshake.php'
+                               '?version=%s&platform=linux'
+                               '&platformversion=Unix%%2FLinux&username=%s'
+                               '&passwordmd5=%s'),
+                adjust_url=base_url + '/adjust.php?session=%s&url=%s&lang=en',
+                xspf_url=base_url + '/xspf.php?sk=%s&discovery=%s&desktop=%s')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/radio/handshake.php':
+            self.send_text('session=%s\nbase_url=%s\n' %
+                           (server.new_session(), self.headers['Host']))
+        elif url.path == '/radio/adjust.php':
+            if query.get('session') not in server.sessions:
+                self.send_text('response=FAILED\nerror=3\n')
+            else:
+                self.send_text('response=OK\nstationname=Fake Station\n')
+        elif url.path == '/radio/xspf.php':
+            if query.get('sk') not in server.sessions:
+                self.send_error(403)
+            elif server.unavailable():
+                self.send_error(503)
+            else:
+                self.send_text(server.playlist(self.headers['Host']),
+                               'text/xml')
+        elif url.path.startswith('/stream/'):
+            if server.unavailable():
+                self.send_error(503)
+            else:
+                self.send_stream()
+        else:
+            self.send_error(404)
+
+    def send_text(self, body, content_type='text/plain'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self):
+        server = self.server
+        size = server.track_size
+        start = 0
+        value = self.headers.get('Range', '')
+        if value.startswith('bytes=') and value.endswith('-'):
+            start = int(value[6:-1])
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        end = size
+        if server.disconnect_rate and random.random() < server.disconnect_rate:
+            end = random.randint(start, size - 1)
+            self.close_connection = 1
+        started = time.time()
+        position = start
+        while position < end:
+            n = min(CHUNK_SIZE, end - position)
+            offset = position % len(FRAME)
+            self.wfile.write(FRAMES[offset:offset + n])
+            position += n
+            if server.bandwidth:
+                # Sleep until the bytes sent so far are due
+                delay = (started + (position - start) / server.bandwidth -
+                         time.time())
+                if delay > 0:
+                    time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLastfm(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, bandwidth=0,
+                 error_rate=0, disconnect_rate=0, tracks=5,
+                 track_size=1024 * 1024):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        # Seconds before every response
+        self.latency = latency
+        # Bytes per second per stream, 0 for no limit
+        self.bandwidth = float(bandwidth)
+        # Share of playlist and stream requests answered with 503
+        self.error_rate = error_rate
+        # Share of streams cut off before the end
+        self.disconnect_rate = disconnect_rate
+        self.tracks = tracks
+        self.track_size = track_size
+        self.sessions = set()
+        self.playlists = 0
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        with self.lock:
+            session = '%032x' % random.getrandbits(128)
+            self.sessions.add(session)
+            return session
+
+    def unavailable(self):
+        return self.error_rate and random.random() < self.error_rate
+
+    def playlist(self, host):
+        with self.lock:
+            self.playlists += 1
+            playlist = self.playlists
+        tracks = [ TRACK % dict(host=host, playlist=playlist, i=i)
+                   for i in range(self.tracks) ]
+        return PLAYLIST % ''.join(tracks)
+
+    def start(self):
+        thread = threading.Thread(name='fakelastfm',
+                                  target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def add_server_options(parser):
+    parser.add_option('--latency', dest='latency', type='float', default=0,
+                      help='milliseconds before every response'
+                           ' [default: %default]')
+    parser.add_option('--bandwidth', dest='bandwidth', type='float',
+                      default=0,
+                      help='KiB/s per stream, 0 for no limit'
+                           ' [default: %default]')
+    parser.add_option('--error-rate', dest='error_rate', type='float',
+                      default=0,
+                      help='share of playlist and stream requests answered'
+                           ' with 503 [default: %default]')
+    parser.add_option('--disconnect-rate', dest='disconnect_rate',
+                      type='float', default=0,
+                      help='share of streams cut off before the end'
+                           ' [default: %default]')
+    parser.add_option('--tracks', dest='tracks', type='int', default=5,
+                      help='tracks per playlist [default: %default]')
+    parser.add_option('--track-size', dest='track_size', type='int',
+                      default=1024,
+                      help='KiB per track [default: %default]')
+
+
+def make_server(options, address=('127.0.0.1', 0)):
+    return FakeLastfm(address, latency=options.latency / 1000.0,
+                      bandwidth=options.bandwidth * 1024,
+                      error_rate=options.error_rate,
+                      disconnect_rate=options.disconnect_rate,
+                      tracks=options.tracks,
+                      track_size=options.track_size * 1024)
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--port', '-p', dest='port', type='int', default=8080,
+                      help='port to listen on [default: %default]')
+    add_server_options(parser)
+    options, args = parser.parse_args()
+    server = make_server(options, ('127.0.0.1', options.port))
+    print 'Serving on http://%s:%d/radio' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options] [benchmark...]
+
+Time functions called once or more per track and compare them with the
+baselines stored in micro_baseline.json. Times are divided by the time of
+a fixed calibration loop so that baselines saved on one machine can be
+checked on another.
+
+Exits with status 1 if any benchmark got slower than its baseline by more
+than --threshold. Use --save after an intended change to store new
+baselines.
+'''
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from cStringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from lastrecorder import util
+from lastrecorder.radio import RadioClient, Track
+from lastrecorder.template import PathTemplate
+from xspf_parser import make_playlist
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'micro_baseline.json')
+HANDSHAKE = ('session=0123456789abcdef0123456789abcdef\n'
+             'stream_url=http://87.117.229.205:80/last.mp3?Session=x\n'
+             'subscriber=0\nframehack=0\nbase_url=ws.audioscrobbler.com\n'
+             'base_path=/radio\ninfo_message=\nfingerprint_upload_url=x\n'
+             'permit_bootstrap=0\nfreetrial=0\n')
+
+
+def make_track():
+    return Track(location='http://play.last.fm/user/1.mp3',
+                 title='Comfortably Numb: Live? "1980"',
+                 album='Is There Anybody Out There? The Wall Live',
+                 creator='Pink Floyd')
+
+
+def calibration():
+    '''Fixed workload the other timings are relative to
+    '''
+    d = {}
+    for i in range(100):
+        d['%d' % i] = ' '.join(['x'] * 10).replace(' ', '_')
+
+
+def benchmarks(tmpdir):
+    '''Returns list of (name, callable)
+    '''
+    track = make_track()
+    template = PathTemplate('{artist:.1}/{artist}/{album}/{title}.mp3')
+    client = RadioClient(outdir=tmpdir)
+    playlist = make_playlist(5, 16)
+    # Worst case: only the last naming scheme tried exists
+    path = os.path.join(tmpdir, track.getpath(True, True))
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    return [
+        ('Track.getpath', lambda: track.getpath()),
+        ('Track.getpath stripped', lambda: track.getpath(True, True)),
+        ('Track.strip_windows_incompat',
+         lambda: track.strip_windows_incompat(track['title'])),
+        ('Track.make_filename', lambda: track.make_filename()),
+        # Uncached rendering, getpath computes each path once per track
+        ('PathTemplate.render', lambda: template.render(track, True, True)),
+        ('Track.find_existing', lambda: track.find_existing(tmpdir)),
+        ('RadioClient.parse_vars',
+         lambda: client.parse_vars(StringIO(HANDSHAKE))),
+        ('RadioClient.parse_xspf',
+         lambda: client.parse_xspf(StringIO(playlist))),
+        ('util.quote_url',
+         lambda: util.quote_url('lastfm://globaltags/russian rock')),
+    ]
+
+
+def calls_per_measurement(timer):
+    # Enough calls to take 0.05 s
+    number = 1
+    while timer.timeit(number) < 0.05:
+        number *= 10
+    return number
+
+
+def measure(func, repeat):
+    '''Returns best time of one call of `func` and of `calibration` in
+    seconds. Both are measured in turns so that both see the same changes
+    of machine load and CPU frequency.
+    '''
+    timers = [timeit.Timer(func), timeit.Timer(calibration)]
+    numbers = [ calls_per_measurement(t) for t in timers ]
+    best = [None, None]
+    for i in range(repeat):
+        for j, timer in enumerate(timers):
+            seconds = timer.timeit(numbers[j]) / numbers[j]
+            if best[j] is None or seconds < best[j]:
+                best[j] = seconds
+    return best
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    fp = open(path)
+    try:
+        return json.load(fp)
+    finally:
+        fp.close()
+
+
+def save_baseline(path, results):
+    fp = open(path, 'w')
+    try:
+        json.dump(results, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+    finally:
+        fp.close()
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--repeat', '-r', dest='repeat', type='int', default=9,
+                      help='measurements to take best of [default: %default]')
+    parser.add_option('--threshold', '-t', dest='threshold', type='float',
+                      default=0.25,
+                      help=('allowed slowdown against baseline, 0.25 is 25%%'
+                            ' [default: %default]'))
+    parser.add_option('--baseline', '-b', dest='baseline', default=BASELINE,
+                      help='baseline file [default: %default]')
+    parser.add_option('--save', '-s', dest='save', action='store_true',
+                      help='store results as new baselines')
+    options, names = parser.parse_args()
+    # Track names mix byte and unicode strings, as in lastrecorder.main
+    reload(sys).setdefaultencoding('utf-8')
+    logging.basicConfig(level=logging.CRITICAL)
+
+    baseline = load_baseline(options.baseline)
+    tmpdir = tempfile.mkdtemp(prefix='lastrecorder-micro.')
+    results = {}
+    failed = []
+    print '%-30s %13s %8s %8s' % ('benchmark', 'time', 'relative',
+                                  'change')
+    try:
+        for name, func in benchmarks(tmpdir):
+            if names and name not in names:
+                continue
+            seconds, unit = measure(func, options.repeat)
+            relative = seconds / unit
+            results[name] = relative
+            line = '%-30s %10.2f us %8.4f' % (name, seconds * 1e6, relative)
+            if name in baseline:
+                change = relative / baseline[name] - 1
+                line += ' %+7.1f%%' % (change * 100)
+                if change > options.threshold:
+                    line += ' FAIL'
+                    failed.append(name)
+            print line
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+    if options.save:
+        baseline.update(results)
+        save_baseline(options.baseline, baseline)
+        print 'Saved baselines to %s' % options.baseline
+    elif failed:
+        print 'FAIL: %s slower than baseline by more than %d%%' % (
+            ', '.join(failed), options.threshold * 100)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
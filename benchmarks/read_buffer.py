@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options]
+
+Compare CPU time per MB spent receiving a stream with fixed 512 byte reads
+(the old handle_stream loop) and with lastrecorder.radio.ReadBuffer. Data is
+sent by a forked child process over a socket pair so that only the
+receiving side is measured.
+'''
+import os
+import sys
+import select
+import socket
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from lastrecorder.radio import ReadBuffer, SOCKET_READ_SIZE
+
+MB = 1024 * 1024
+
+
+def send(sock, size):
+    chunk = 'x' * 64 * 1024
+    sent = 0
+    while sent < size:
+        sock.sendall(chunk)
+        sent += len(chunk)
+    sock.close()
+
+
+def receive_fixed(sock, fp, size):
+    rfile = sock.makefile('rb', 0)
+    count = 0
+    while count < size:
+        select.select([sock], [], [sock], 0.1)
+        data = rfile.read(SOCKET_READ_SIZE)
+        if not data:
+            break
+        count += len(data)
+        fp.write(data)
+
+
+def receive_buffer(sock, fp, size):
+    buf = ReadBuffer()
+    count = 0
+    while count < size:
+        select.select([sock], [], [sock], 0.1)
+        data = buf.recv(sock)
+        if not data:
+            break
+        count += len(data)
+        fp.write(data)
+
+
+def run(receiver, size):
+    parent, child = socket.socketpair()
+    pid = os.fork()
+    if not pid:
+        parent.close()
+        send(child, size)
+        os._exit(0)
+    child.close()
+    fp = tempfile.TemporaryFile()
+    start = os.times()
+    try:
+        receiver(parent, fp, size)
+    finally:
+        end = os.times()
+        os.waitpid(pid, 0)
+        parent.close()
+        fp.close()
+    cpu = (end[0] - start[0]) + (end[1] - start[1])
+    wall = end[4] - start[4]
+    return cpu, wall
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--size', '-s', dest='size', type='int', default=64,
+                      help='megabytes to transfer per run [default: %default]')
+    parser.add_option('--repeat', '-r', dest='repeat', type='int', default=3,
+                      help='runs per receiver [default: %default]')
+    options, args = parser.parse_args()
+    size = options.size * MB
+
+    for name, receiver in [('fixed %d' % SOCKET_READ_SIZE, receive_fixed),
+                           ('ReadBuffer', receive_buffer)]:
+        results = [ run(receiver, size) for i in range(options.repeat) ]
+        cpu, wall = min(results)
+        print '%-12s %8.4f CPU s/MB %8.2f MB/s' % (
+            name, cpu / options.size, options.size / max(wall, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
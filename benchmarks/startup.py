@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options]
+
+Measure lastrecorder-cli startup: wall clock time from starting a fresh
+interpreter to the first network request. Every run gets HOME in a
+temporary directory and http_proxy pointing to a local server which notes
+when the first request arrives and refuses the login so that the client
+exits.
+
+With --imports one more run reports self and cumulative time of every
+imported module in the format of python -X importtime (which Python 2
+lacks) and lists GUI and tagging modules that have been imported.
+
+Exits with status 1 if median time exceeds --max-ms.
+'''
+import __builtin__
+import atexit
+import BaseHTTPServer
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser, SUPPRESS_HELP
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+# Modules that shouldn't be imported before the first request
+DEFERRED = ['gtk', 'gobject', 'pygtk', 'mutagen', 'lastrecorder.gui']
+
+
+class ImportTimer(object):
+    '''Time every import that loads new modules
+    '''
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.original = __builtin__.__import__
+
+    def install(self):
+        __builtin__.__import__ = self.timed_import
+
+    def timed_import(self, name, *args, **kw):
+        before = set(sys.modules)
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.original(name, *args, **kw)
+        finally:
+            elapsed = time.time() - start
+            children = self.stack.pop()
+            # Python 2 adds None entries for failed implicit relative imports
+            loaded = [ m for m, module in sys.modules.items()
+                       if m not in before and module is not None ]
+            if loaded:
+                if self.stack:
+                    self.stack[-1] += elapsed
+                self.records.append((len(self.stack),
+                                     self.label(name, args, loaded),
+                                     elapsed - children, elapsed))
+
+    def label(self, name, args, loaded):
+        '''Name of the module imported by import statement
+        '''
+        fromlist = len(args) > 2 and args[2] or ()
+        names = [ '%s.%s' % (name, f) for f in fromlist or () ] + [name]
+        for candidate in names:
+            for module in loaded:
+                if module == candidate or module.endswith('.' + candidate):
+                    return module
+        return min(loaded, key=len)
+
+    def report(self):
+        lines = ['import time: self [us] | cumulative | imported package']
+        for depth, name, own, cumulative in self.records:
+            lines.append('import time: %9d | %10d | %s%s' % (
+                own * 1e6, cumulative * 1e6, '  ' * depth, name))
+        loaded = [ m for m in DEFERRED if sys.modules.get(m) is not None ]
+        lines.append('deferred modules imported: %s' %
+                     (', '.join(loaded) or 'none'))
+        return '\n'.join(lines) + '\n'
+
+
+class FirstRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.server.first_request is None:
+            self.server.first_request = time.time()
+        body = 'session=FAILED\nmsg=Startup benchmark\n'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def child(report, args):
+    '''Run lastrecorder-cli with `args` writing import report to `report`
+    '''
+    timer = ImportTimer()
+    timer.install()
+    def write_report():
+        fp = open(report, 'w')
+        try:
+            fp.write(timer.report())
+        finally:
+            fp.close()
+    atexit.register(write_report)
+    sys.argv = ['lastrecorder-cli'] + args
+    from lastrecorder.main import cli_main
+    sys.exit(cli_main())
+
+
+def make_home():
+    home = tempfile.mkdtemp(prefix='lastrecorder-startup.')
+    configdir = os.path.join(home, '.config', 'lastrecorder')
+    os.makedirs(configdir)
+    fp = open(os.path.join(configdir, 'lastrecorder.cfg'), 'w')
+    try:
+        fp.write('[lastfm_user]\nusername = benchmark\n'
+                 'passwordmd5 = 0123456789abcdef0123456789abcdef\n'
+                 '[options]\noutdir = %s\n' % os.path.join(home, 'music'))
+    finally:
+        fp.close()
+    return home
+
+
+def run(server, command):
+    '''Start `command` and wait for it. Returns seconds from start to the
+    first request received by `server`
+    '''
+    home = make_home()
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT,
+               http_proxy='http://127.0.0.1:%d' % server.server_port)
+    env.pop('no_proxy', None)
+    env.pop('NO_PROXY', None)
+    server.first_request = None
+    try:
+        start = time.time()
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.call(command, env=env, stdout=devnull,
+                            stderr=subprocess.STDOUT)
+        finally:
+            devnull.close()
+    finally:
+        shutil.rmtree(home, True)
+    if server.first_request is None:
+        raise RuntimeError('%s made no requests' % ' '.join(command))
+    return server.first_request - start
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--repeat', '-r', dest='repeat', type='int', default=5,
+                      help='runs to take median of [default: %default]')
+    parser.add_option('--imports', '-i', dest='imports', action='store_true',
+                      help='report import times')
+    parser.add_option('--max-ms', '-m', dest='max_ms', type='float',
+                      help='fail if median startup time exceeds this')
+    parser.add_option('--child', dest='child', help=SUPPRESS_HELP)
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args()
+    if options.child:
+        child(options.child, args)
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FirstRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    args = ['lastfm://globaltags/jazz']
+    command = [sys.executable, '-c',
+               'import sys; from lastrecorder.main import cli_main;'
+               ' sys.exit(cli_main())'] + args
+    times = sorted(run(server, command) for i in range(options.repeat))
+    median = times[len(times) // 2] * 1000
+    print 'first request after %.1f ms (median of %d, min %.1f, max %.1f)' % (
+        median, len(times), times[0] * 1000, times[-1] * 1000)
+
+    if options.imports:
+        fd, report = tempfile.mkstemp(prefix='lastrecorder-imports.')
+        os.close(fd)
+        try:
+            run(server, [sys.executable, os.path.abspath(__file__),
+                         '--child', report] + args)
+            sys.stdout.write(open(report).read())
+        finally:
+            os.unlink(report)
+
+    server.shutdown()
+    if options.max_ms is not None and median > options.max_ms:
+        print 'FAIL: %.1f ms > %.1f ms' % (median, options.max_ms)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
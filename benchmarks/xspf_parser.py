@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+  %prog [options]
+
+Time lastrecorder.radio.XSPFParser against the xml.sax based handler it
+replaced on a synthetic XSPF playlist.
+'''
+import os
+import sys
+import time
+import logging
+import xml.sax
+
+from cStringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from lastrecorder.radio import XSPFParser
+
+TRACK = '''    <track>
+      <location>http://play.last.fm/user/%(i)d.mp3</location>
+      <title>Title %(i)d %(text)s</title>
+      <id>%(i)d</id>
+      <album>Album %(i)d</album>
+      <creator>Artist %(i)d</creator>
+      <duration>240000</duration>
+      <image>http://userserve-ak.last.fm/serve/174s/%(i)d.jpg</image>
+      <extension application="http://www.last.fm">
+        <trackauth>%(i)05d</trackauth>
+        <artistpage>http://www.last.fm/music/Artist+%(i)d</artistpage>
+      </extension>
+    </track>
+'''
+
+
+def make_playlist(count, text_size):
+    text = 'x' * text_size
+    tracks = ''.join([ TRACK % dict(i=i, text=text) for i in range(count) ])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<playlist version="1" xmlns:lastfm="http://www.audioscrobbler.net/dtd/xspf-lastfm">\n'
+            '  <title>Synthetic</title>\n'
+            '  <trackList>\n%s  </trackList>\n</playlist>\n' % tracks)
+
+
+class SAXHandler(xml.sax.ContentHandler):
+    '''XSPFHandler as it was before XSPFParser
+    '''
+    def __init__(self):
+        self.depth = -1
+        self.indent = '  '
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.data = ''
+        self.tracks = []
+        self.track = None
+        self.track_attr = None
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        i = self.indent
+        a = [ '%s=%s' % item for item in attrs.items()]
+        self.log.debug('%s+%s %s', i * self.depth, name, a)
+        if self.depth == 2 and name == 'track':
+            self.track = dict()
+        if self.depth == 3 and self.track is not None:
+            self.track_attr = name
+            self.track.setdefault(name, None)
+
+    def characters(self, data):
+        self.data += data
+
+    def endElement(self, name):
+        i = self.indent
+        data = self.data.strip()
+        self.log.debug('%s %s', i * self.depth, data)
+        if self.depth == 3 and self.track_attr is not None:
+            self.track[self.track_attr] = data
+        if self.depth == 2 and name == 'track':
+            self.tracks.append(self.track)
+            self.track = None
+        self.depth -= 1
+        self.data = ''
+
+
+def parse_sax(data):
+    h = SAXHandler()
+    xml.sax.parse(StringIO(data), h)
+    return h.tracks
+
+
+def parse_expat(data):
+    return XSPFParser().parse(StringIO(data))
+
+
+def bench(func, data, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        tracks = func(data)
+        times.append(time.time() - start)
+    return min(times), tracks
+
+
+def main():
+    parser = OptionParser(usage=__doc__.rstrip())
+    parser.add_option('--tracks', '-t', dest='tracks', type='int',
+                      default=5000,
+                      help='tracks in playlist [default: %default]')
+    parser.add_option('--text-size', '-s', dest='text_size', type='int',
+                      default=64,
+                      help='extra characters per title [default: %default]')
+    parser.add_option('--repeat', '-r', dest='repeat', type='int', default=5,
+                      help='runs per parser [default: %default]')
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    data = make_playlist(options.tracks, options.text_size)
+    print '%d tracks, %d bytes' % (options.tracks, len(data))
+    results = []
+    for name, func in [('xml.sax', parse_sax), ('XSPFParser', parse_expat)]:
+        seconds, tracks = bench(func, data, options.repeat)
+        results.append(tracks)
+        print '%-12s %8.4f s %10.0f tracks/s' % (name, seconds,
+                                                 len(tracks) / seconds)
+    if [ t['title'] for t in results[0] ] != [ t['title'] for t in results[1] ]:
+        print 'WARNING: parsers disagree'
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,10 @@
 import os
 import sys
 
-__all__ = ['NAME', 'DOTDIR', 'MUSICDIR', 'LOGFILE', 'IS_WINDOWS', 'DEFAULTS']
+from lastrecorder.template import DEFAULT_TEMPLATE
+
+__all__ = ['NAME', 'DOTDIR', 'MUSICDIR', 'LOGFILE', 'CATALOG', 'SESSIONS',
+           'IS_WINDOWS', 'DEFAULTS']
 
 AUTHORS = ['Timur Izhbulatov']
 DISPLAY_NAME = 'Last Recorder'
@@ -25,7 +28,12 @@ CONFIGDIR = os.path.join(HOME, '.config', NAME)
 DOTDIR = os.path.join(HOME, '.local', 'share', NAME)
 MUSICDIR = os.path.join(DOTDIR, 'music')
 LOGFILE = os.path.join(DOTDIR, '%s.log' % NAME)
+CATALOG = os.path.join(DOTDIR, 'catalog.db')
+SESSIONS = os.path.join(DOTDIR, 'sessions.cfg')
 IS_WINDOWS = sys.platform.lower().startswith('win')
 DEFAULTS = dict(save=True, debug=False, quote=True, skip_existing=True,
                 strip_windows_incompat=True, strip_spaces=True,
-                outdir=MUSICDIR, gui=True)
+                outdir=MUSICDIR, gui=True, jobs=1,
+                event_loop=False, rescan=False, write_buffer=1024,
+                min_rate=4, stall_window=30, path_template=DEFAULT_TEMPLATE,
+                log_queue=True)
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Event loop recording engine.
+
+``AsyncRadioClient`` records up to ``jobs`` playlist tracks at once from a
+single thread. All open streams are multiplexed with one ``select`` call
+which only wakes up when some stream has data, the client is cancelled (or
+every ``idle_interval`` seconds to let ``read_cb`` run while the streams
+are idle). Received data is written to disk by one more thread shared by
+all streams, a stream isn't read while its write queue is full.
+'''
+
+import errno
+import httplib
+import os
+import select
+import socket
+import time
+import urllib2
+
+from lastrecorder.exceptions import SkipTrack
+from lastrecorder import connpool
+from lastrecorder import util
+from lastrecorder.writer import FileWriter, WriterThread
+from lastrecorder.radio import (RadioClient, ReadBuffer, detach_socket,
+                                SOCKET_TIMEOUT, RESUME_ATTEMPTS)
+
+
+class Stream(object):
+    '''A track being recorded by ``AsyncRadioClient``
+    '''
+    def __init__(self, track, fp, tmp, start, watchdog, writer_thread=None):
+        self.track = track
+        self.fp = fp
+        self.writer = FileWriter(fp, thread=writer_thread)
+        self.tmp = tmp
+        # Offset of audio data in fp
+        self.start = start
+        self.buffer = ReadBuffer()
+        self.res = None
+        self.sock = None
+        self.buffered = ''
+        self.length = None
+        self.offset = 0
+        self.count = 0
+        self.attempts = 0
+        self.started = None
+        self.first_byte = None
+        self.last_read = None
+        self.watchdog = watchdog
+
+    def attach(self, res, offset, length, started):
+        '''Read the rest of audio stream starting at byte `offset` from
+        response `res`
+        '''
+        self.res = res
+        self.sock, self.buffered = detach_socket(res)
+        self.length = length
+        self.offset = self.count = offset
+        self.started = started
+        self.first_byte = None
+        self.last_read = time.time()
+        self.watchdog.start(self.last_read)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class AsyncRadioClient(RadioClient):
+    idle_interval = 0.5
+    # How often streams not read while their write queue is full are checked
+    paused_interval = 0.05
+
+    def handle_tracks(self):
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        pending = list(self.tracks)
+        streams = []
+        # One thread writes all streams
+        self.writer_thread = WriterThread()
+        try:
+            while pending or streams:
+                while pending and len(streams) < max(self.jobs, 1):
+                    if len(pending) == 1:
+                        self.start_prefetch()
+                    stream = self.open_stream(pending.pop(0))
+                    if stream is not None:
+                        streams.append(stream)
+                if not streams:
+                    continue
+                try:
+                    self.poll_streams(streams)
+                except KeyboardInterrupt:
+                    self.log.info('Interrupted. Skipping tracks.')
+                    for stream in streams[:]:
+                        self.skip_stream(stream, streams)
+                    time.sleep(0.2)
+        finally:
+            for stream in streams:
+                self.close_stream(stream)
+            self.writer_thread.stop()
+        # Not when stopped, that would use up a playlist
+        self.start_prefetch()
+
+    def open_stream(self, track):
+        '''Request `track` audio stream. Returns ``Stream`` or ``None`` if
+        track has been skipped
+        '''
+        log = self.log
+        try:
+            # Reading a bit of a skipped stream can be cancelled as well
+            if self.skip_existing_track(track):
+                self.track_skipped(track)
+                return
+            self.call(self.track_start_cb, track)
+            log.info(track.name)
+            fp, tmp, start = self.open_temp_file(track)
+        except SkipTrack:
+            self.track_skipped(track)
+            return
+        except Exception, e:
+            log.exception('open_stream: %s', e)
+            log.error('Skipping track.')
+            self.track_skipped(track)
+            return
+        stream = Stream(track, fp, tmp, start, self.make_watchdog(),
+                        self.writer_thread)
+        try:
+            self.connect_stream(stream)
+        except SkipTrack:
+            self.close_stream(stream)
+            self.track_skipped(track)
+            return
+        except EnvironmentError:
+            self.close_stream(stream, keep=True)
+            self.track_failed(track)
+            return
+        except Exception, e:
+            log.exception('open_stream: %s', e)
+            log.error('Skipping track.')
+            self.close_stream(stream)
+            self.track_skipped(track)
+            return
+        return stream
+
+    def connect_stream(self, stream):
+        '''Request audio stream for `stream` resuming it if some of it has
+        been recorded. Raises ``SkipTrack`` if the track is unavailable.
+        '''
+        log = self.log
+        exceptions = (IOError, OSError, socket.error, httplib.HTTPException)
+        track = stream.track
+        stream.writer.flush()
+        stream.fp.seek(0, os.SEEK_END)
+        offset = stream.fp.tell() - stream.start
+        started = time.time()
+        try:
+            res, count, length = self.request_stream(track, offset)
+        except urllib2.HTTPError, e:
+            log.exception(e)
+            if offset:
+                raise
+            log.info('Skipping %s', track.name)
+            raise SkipTrack
+        except (IndexError, ValueError):
+            log.error('Failed to get Content-Length')
+            raise IOError('No Content-Length')
+        except exceptions, e:
+            log.exception(e)
+            raise IOError(*e.args)
+        if count < offset:
+            stream.fp.seek(stream.start + count)
+            stream.fp.truncate()
+        util.preallocate(stream.fp, length - count)
+        stream.attach(res, count, length, started)
+
+    def resume_stream(self, stream):
+        '''Reconnect interrupted `stream` right away, there is no pause
+        between attempts not to hold up other streams. Returns ``True`` on
+        success
+        '''
+        while stream.attempts < RESUME_ATTEMPTS:
+            stream.attempts += 1
+            self.close_response(stream)
+            if self.cancel.is_cancelled():
+                return False
+            self.log.info('Resuming %s at %d bytes', stream.track.name,
+                          stream.count)
+            try:
+                self.connect_stream(stream)
+            except (SkipTrack, EnvironmentError):
+                continue
+            return True
+        return False
+
+    def poll_streams(self, streams):
+        '''Wait for data on any of `streams` and handle it. Streams whose
+        write queue is full are not read until the disk catches up.
+        '''
+        log = self.log
+        ready = []
+        for stream in streams[:]:
+            try:
+                if stream.writer.ready(stream.buffer.max_size):
+                    ready.append(stream)
+            except (IOError, OSError), e:
+                log.exception('poll_streams: write: %s', e)
+                self.abort_stream(stream, streams)
+        if not streams:
+            return
+        timeout = self.idle_interval
+        if [ s for s in ready if s.buffered ]:
+            timeout = 0
+        elif len(ready) < len(streams):
+            timeout = self.paused_interval
+        try:
+            r, w, x = select.select(ready + [self.cancel], [], ready,
+                                    timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if self.cancel in r:
+            # Stopping raises here, skipping drops the oldest stream
+            r.remove(self.cancel)
+            self.stream_call(streams[0], streams, self.cancel.check)
+        elif not r and not x:
+            # Give a chance to skip the oldest track while streams are idle
+            self.stream_call(streams[0], streams, self.read_cb)
+        r += [ s for s in ready if s.buffered ]
+        for stream in set(r + x):
+            if stream in streams:
+                self.read_stream(stream, streams)
+        now = time.time()
+        for stream in streams[:]:
+            if stream not in ready:
+                # Waiting for the disk is not a read timeout
+                stream.last_read = now
+            elif now - stream.last_read > SOCKET_TIMEOUT:
+                self.stream_aborted(stream.track, stream.res, 'timeout',
+                                    'Read timeout reached')
+                self.fail_stream(stream, streams)
+                continue
+            slow = stream.watchdog.check(now)
+            if slow:
+                self.stream_aborted(stream.track, stream.res, 'slow',
+                                    'Stream too slow (%s)' % slow)
+                self.fail_stream(stream, streams)
+
+    def read_stream(self, stream, streams):
+        log = self.log
+        try:
+            if stream.buffered:
+                data, stream.buffered = stream.buffered, ''
+            else:
+                data = stream.buffer.recv(stream.sock)
+        except socket.error, e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                return
+            log.exception('read_stream: %s', e)
+            self.fail_stream(stream, streams)
+            return
+        if not data:
+            self.stream_aborted(stream.track, stream.res, 'closed',
+                                'Connection closed')
+            self.fail_stream(stream, streams)
+            return
+        stream.last_read = time.time()
+        if stream.first_byte is None:
+            stream.first_byte = stream.last_read
+        stream.count += len(data)
+        stream.watchdog.update(len(data), stream.last_read)
+        try:
+            # Doesn't block, poll_streams() checked there is room
+            stream.writer.write(data)
+        except (IOError, OSError), e:
+            log.exception('read_stream: write: %s', e)
+            self.abort_stream(stream, streams)
+            return
+        if not self.stream_call(stream, streams, self.progress_cb,
+                                stream.track, stream.count, stream.length):
+            return
+        if stream.count >= stream.length:
+            try:
+                stream.writer.flush()
+            except (IOError, OSError), e:
+                log.exception('read_stream: write: %s', e)
+                self.abort_stream(stream, streams)
+                return
+            streams.remove(stream)
+            if stream.count == stream.length:
+                connpool.release(stream.res)
+            self.close_stream(stream, finish=True)
+            try:
+                self.track_recorded(stream.track)
+            except SkipTrack:
+                pass
+
+    def stream_call(self, stream, streams, callback, *args):
+        '''Run `callback` on behalf of `stream`. ``SkipTrack`` raised by the
+        callback skips only that stream. Returns ``False`` if skipped.
+        '''
+        try:
+            self.call(callback, *args)
+        except SkipTrack:
+            self.skip_stream(stream, streams)
+            return False
+        return True
+
+    def skip_stream(self, stream, streams):
+        self.drop_stream(stream, streams)
+        self.track_skipped(stream.track)
+
+    def fail_stream(self, stream, streams):
+        if self.resume_stream(stream):
+            return
+        self.abort_stream(stream, streams)
+
+    def abort_stream(self, stream, streams):
+        '''Give up `stream` keeping what has been recorded. Disk errors are
+        not retried like read errors.
+        '''
+        streams.remove(stream)
+        self.close_stream(stream, keep=True)
+        self.track_failed(stream.track)
+
+    def drop_stream(self, stream, streams):
+        streams.remove(stream)
+        self.close_stream(stream)
+
+    def close_response(self, stream):
+        if stream.res is None:
+            return
+        self.observe_stream(stream.res, stream.started, stream.first_byte,
+                            stream.count - stream.offset)
+        try:
+            stream.res.close()
+        except (IOError, OSError, socket.error):
+            pass
+        stream.res = stream.sock = None
+        stream.buffered = ''
+
+    def close_stream(self, stream, keep=False, finish=False):
+        '''Close `stream`. Its temporary file is queued for finishing if
+        `finish` is true, otherwise removed unless `keep` is true and some
+        audio data has been recorded
+        '''
+        self.close_response(stream)
+        # Otherwise the writer thread closes fp once the stalled write
+        # returns
+        if stream.writer.close():
+            if keep and not stream.fp.closed:
+                # Release space preallocated for the rest of the stream
+                stream.fp.seek(0, os.SEEK_END)
+                stream.fp.truncate()
+                keep = stream.fp.tell() > stream.start
+            try:
+                stream.fp.close()
+            except (IOError, OSError):
+                pass
+        if finish:
+            self.queue_finish(stream.track, stream.tmp)
+        elif keep:
+            self.keep_temp_file(stream.tmp)
+        else:
+            self.remove_temp_file(stream.tmp)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Cancellation of a recording from another thread.
+
+``CancelToken`` combines a ``threading.Event`` with a self-pipe. Threads
+blocked in ``select`` add the token to the set of watched descriptors and
+wake up as soon as it is cancelled instead of polling a flag.
+'''
+
+from __future__ import with_statement
+import errno
+import socket
+import threading
+
+
+def wakeup_pair():
+    '''Returns pair of connected sockets. Sockets rather than os.pipe() so
+    that select works with them on Windows too.
+    '''
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader, addr = listener.accept()
+    finally:
+        listener.close()
+    return reader, writer
+
+
+class CancelToken(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.exception = None
+        self.once = False
+        self.reader, self.writer = wakeup_pair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno(self):
+        '''Descriptor that becomes readable when the token is cancelled
+        '''
+        return self.reader.fileno()
+
+    def cancel(self, exception, once=False):
+        '''Make `check` raise `exception`. With `once` it is raised by the
+        first check only (e.g. to skip current track), otherwise until
+        `reset`. Pending permanent cancellation is not replaced by a one
+        time one.
+        '''
+        with self.lock:
+            if self.event.isSet() and not self.once and once:
+                return
+            self.exception = exception
+            self.once = once
+            self.event.set()
+            try:
+                self.writer.send('x')
+            except socket.error, e:
+                # Pipe is full, so it is readable anyway
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def is_cancelled(self):
+        return self.event.isSet()
+
+    def check(self, once=True):
+        '''Raise exception given to `cancel` if cancelled. One time
+        cancellation is left for another check unless `once` is true.
+        '''
+        if not self.event.isSet():
+            return
+        with self.lock:
+            if self.once and not once:
+                return
+            exception = self.exception
+            if self.once:
+                self.clear()
+        if exception is not None:
+            raise exception
+
+    def wait(self, timeout=None):
+        '''Sleep up to `timeout` seconds or until cancelled. Returns
+        ``True`` if cancelled
+        '''
+        self.event.wait(timeout)
+        return self.event.isSet()
+
+    def reset(self):
+        with self.lock:
+            self.clear()
+
+    def clear(self):
+        self.event.clear()
+        self.exception = None
+        self.once = False
+        while True:
+            try:
+                if not self.reader.recv(4096):
+                    break
+            except socket.error:
+                break
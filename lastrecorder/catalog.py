@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''SQLite catalog of recorded tracks.
+
+Tracks are looked up by their path in the output directory rendered with
+the path template and normalized, so that a file recorded with any
+combination of naming options is found without probing the file system.
+'''
+
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from lastrecorder.template import default_template
+
+DatabaseError = getattr(sqlite3, 'Error', EnvironmentError)
+
+# Characters replaced by any of the naming options and the dash path
+# separators in names are replaced with (see Track.getpath)
+SEPARATORS = '\\/:*?;"<>| -'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    outdir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    recorded REAL
+);
+CREATE INDEX IF NOT EXISTS tracks_key ON tracks (outdir, name);
+CREATE TABLE IF NOT EXISTS outdirs (
+    outdir TEXT PRIMARY KEY,
+    imported REAL
+);
+'''
+
+
+def to_unicode(value):
+    if isinstance(value, str):
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        return value.decode(encoding, 'replace')
+    return value
+
+
+def normalize(value):
+    '''Reduce `value` to the same string regardless of naming options
+    '''
+    value = to_unicode(value)
+    for c in SEPARATORS:
+        value = value.replace(c, '_')
+    return value.lower()
+
+
+class Catalog(object):
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.imported = set()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = unicode
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def key(self, outdir, name):
+        '''Key of file `name` relative to `outdir`
+        '''
+        outdir = to_unicode(os.path.abspath(outdir))
+        return (outdir, normalize(name))
+
+    def find(self, outdir, track, template=default_template):
+        '''Find `track` recorded in `outdir` with path `template`. Returns
+        path or ``None``
+        '''
+        key = self.key(outdir, template.render(track))
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT path FROM tracks WHERE outdir = ?'
+                                  ' AND name = ? LIMIT 1', key).fetchone()
+        finally:
+            self.lock.release()
+        return row and row[0] or None
+
+    def add(self, outdir, path):
+        key = self.key(outdir, os.path.relpath(path, outdir))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        self.lock.acquire()
+        try:
+            self.db.execute('INSERT OR REPLACE INTO tracks VALUES'
+                            ' (?, ?, ?, ?, ?)',
+                            key + (to_unicode(path), size, time.time()))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def remove(self, path):
+        '''Forget file `path`, e.g. after it has been deleted
+        '''
+        self.lock.acquire()
+        try:
+            self.db.execute('DELETE FROM tracks WHERE path = ?',
+                            (to_unicode(path),))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def import_outdir(self, outdir, force=False):
+        '''Add .mp3 files in `outdir`, whatever path template they have
+        been recorded with, unless it has already been imported. With `force` forget all
+        previously cataloged files in `outdir` first.
+        '''
+        outdir = to_unicode(os.path.abspath(outdir))
+        if outdir in self.imported and not force:
+            return
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT imported FROM outdirs'
+                                  ' WHERE outdir = ?', (outdir,)).fetchone()
+            if row and not force:
+                self.imported.add(outdir)
+                return
+            self.log.info('Importing %s into catalog', outdir)
+            self.db.execute('DELETE FROM tracks WHERE outdir = ?', (outdir,))
+            count = 0
+            for dirpath, dirnames, filenames in os.walk(outdir):
+                for filename in filenames:
+                    ext = os.path.splitext(filename)[1]
+                    # Temporary and partial recordings start with a dot
+                    if filename.startswith('.') or ext.lower() != '.mp3':
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    key = self.key(outdir, os.path.relpath(path, outdir))
+                    self.db.execute('INSERT OR REPLACE INTO tracks VALUES'
+                                    ' (?, ?, ?, ?, ?)',
+                                    key + (to_unicode(path), st.st_size,
+                                           st.st_mtime))
+                    count += 1
+            self.db.execute('INSERT OR REPLACE INTO outdirs VALUES (?, ?)',
+                            (outdir, time.time()))
+            self.db.commit()
+            self.imported.add(outdir)
+            self.log.info('Imported %d tracks', count)
+        finally:
+            self.lock.release()
+
+
+def open_catalog(path):
+    '''Open catalog at `path`. Returns ``None`` if it can't be used
+    '''
+    log = logging.getLogger('Catalog')
+    if sqlite3 is None:
+        log.warn('sqlite3 module not found. Catalog disabled.')
+        return
+    try:
+        return Catalog(path)
+    except DatabaseError, e:
+        log.error('Cannot open catalog %s: %s', path, e)
@@ -23,9 +23,11 @@ class Config(object):
 
     class __metaclass__(type):
         bool_vars = ['strip_windows_incompat', 'strip_spaces',
-                        'skip_existing', 'save', 'debug']
+                        'skip_existing', 'save', 'debug', 'event_loop',
+                        'log_queue']
         login_vars = ['username', 'passwordmd5']
-        str_vars = ['outdir', 'station', 'station_type']
+        str_vars = ['outdir', 'station', 'station_type', 'path_template']
+        int_vars = ['jobs', 'write_buffer', 'min_rate', 'stall_window']
 
         def __new__(mcls, name, bases, namespace):
             for option in mcls.bool_vars:
@@ -39,8 +41,12 @@ class Config(object):
             for option in mcls.str_vars:
                 get, set, delete = mcls.make_accessors(option, 'options', 'get')
                 namespace[option] = property(get, set, delete)
+            for option in mcls.int_vars:
+                get, set, delete = mcls.make_accessors(option, 'options',
+                                                       'getint')
+                namespace[option] = property(get, set, delete)
             namespace['vars'] = (mcls.bool_vars + mcls.login_vars +
-                                 mcls.str_vars)
+                                 mcls.str_vars + mcls.int_vars)
             return type.__new__(mcls, name, bases, namespace)
 
         @staticmethod
@@ -85,6 +91,22 @@ class Config(object):
     def __iter__(self):
         return iter([ (var, getattr(self, var)) for var in self.vars ])
 
+    def accounts(self):
+        '''Get additional Last.fm accounts from "account NAME" sections.
+        Returns dict of NAME: (username, passwordmd5)
+        '''
+        accounts = {}
+        for section in self.parser.sections():
+            if not section.startswith('account '):
+                continue
+            name = section[len('account '):].strip()
+            try:
+                accounts[name] = (self.parser.get(section, 'username'),
+                                  self.parser.get(section, 'passwordmd5'))
+            except NoOptionError:
+                continue
+        return accounts
+
     def clear_password(self):
         try:
             self.parser.remove_option('lastfm_user', 'passwordmd5')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Persistent HTTP connections for urllib2.
+
+``KeepAliveHandler`` replaces the stock ``urllib2.HTTPHandler`` and takes
+connections from a ``ConnectionPool`` instead of opening a new one for
+every request. A connection goes back to the pool when its response has
+been read to the end; responses closed early close their connection.
+Host names are resolved through a small DNS cache.
+'''
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib2
+
+MAX_IDLE_PER_HOST = 4
+MAX_IDLE = 16
+IDLE_TIMEOUT = 15
+DNS_TTL = 300
+
+
+class PooledHTTPResponse(httplib.HTTPResponse):
+    '''Response which returns its connection to the pool when closed after
+    having been read completely
+    '''
+    pool = None
+    connection = None
+    released = False
+
+    def close(self):
+        httplib.HTTPResponse.close(self)
+        if self.released or self.connection is None:
+            return
+        self.released = True
+        if self.will_close or self.length != 0:
+            self.connection.close()
+        else:
+            self.pool.put(self.connection)
+
+
+class PooledHTTPConnection(httplib.HTTPConnection):
+    response_class = PooledHTTPResponse
+
+    def __init__(self, host, port=None, pool=None, **kw):
+        httplib.HTTPConnection.__init__(self, host, port, **kw)
+        self.pool = pool
+        self.key = (self.host, self.port)
+        self.idle_since = None
+
+    def connect(self):
+        address = self.pool.resolve(self.host, self.port)
+        try:
+            self.sock = socket.create_connection(address, self.timeout)
+        except socket.error:
+            self.pool.forget(self.host, self.port)
+            raise
+
+    def getresponse(self, *args, **kw):
+        res = httplib.HTTPConnection.getresponse(self, *args, **kw)
+        res.pool = self.pool
+        res.connection = self
+        return res
+
+
+class ConnectionPool(object):
+    '''Idle HTTP connections keyed by (host, port)
+    '''
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST, max_idle=MAX_IDLE,
+                 idle_timeout=IDLE_TIMEOUT, dns_ttl=DNS_TTL):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.dns_ttl = dns_ttl
+        self.idle = {}
+        self.addresses = {}
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def get(self, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        '''Get idle connection to `host` ("host[:port]") or a new one.
+        Returns (connection, reused)
+        '''
+        conn = PooledHTTPConnection(host, pool=self, timeout=timeout)
+        self.lock.acquire()
+        try:
+            self.evict()
+            idle = self.idle.get(conn.key)
+            if idle:
+                reused = idle.pop()
+                self.log.debug('Reusing connection to %s:%s', *conn.key)
+                return reused, True
+        finally:
+            self.lock.release()
+        return conn, False
+
+    def put(self, conn):
+        if conn.sock is None:
+            return
+        self.lock.acquire()
+        try:
+            self.evict()
+            idle = self.idle.setdefault(conn.key, [])
+            total = sum([ len(l) for l in self.idle.values() ])
+            if len(idle) >= self.max_idle_per_host or total >= self.max_idle:
+                conn.close()
+                return
+            conn.idle_since = time.time()
+            idle.append(conn)
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        '''Close connections idle for longer than ``idle_timeout``. Must be
+        called with ``self.lock`` held.
+        '''
+        deadline = time.time() - self.idle_timeout
+        for key, idle in self.idle.items():
+            for conn in [ c for c in idle if c.idle_since < deadline ]:
+                idle.remove(conn)
+                conn.close()
+            if not idle:
+                del self.idle[key]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def resolve(self, host, port):
+        '''Resolve `host` using cached result if it hasn't expired.
+        Returns (address, port)
+        '''
+        key = (host, port)
+        cached = self.addresses.get(key)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        address = info[0][4][:2]
+        self.addresses[key] = (address, time.time() + self.dns_ttl)
+        return address
+
+    def forget(self, host, port):
+        self.addresses.pop((host, port), None)
+
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def http_open(self, req):
+        if req._tunnel_host:
+            return urllib2.HTTPHandler.http_open(self, req)
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers.pop('Connection', None)
+
+        conn, reused = self.pool.get(host, req.timeout)
+        try:
+            r = self.request(conn, req, headers)
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            if not reused:
+                raise urllib2.URLError(e)
+            # Server has closed idle connection. Retry with a new one
+            conn = PooledHTTPConnection(host, pool=self.pool,
+                                        timeout=req.timeout)
+            try:
+                r = self.request(conn, req, headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        # See urllib2.AbstractHTTPHandler.do_open()
+        r.recv = r.read
+        fp = socket._fileobject(r, close=True)
+
+        resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def request(self, conn, req, headers):
+        conn.set_debuglevel(self._debuglevel)
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        # See urllib2.AbstractHTTPHandler.do_open(). Python before 2.7 has
+        # no buffering argument and reads headers unbuffered, leaving no
+        # body data in the file object for detach_socket() to pick up.
+        try:
+            return conn.getresponse(buffering=True)
+        except TypeError:
+            return conn.getresponse()
+
+
+def release(res):
+    '''Return connection of urllib2 response `res` whose body has been read
+    to the end bypassing the response object (see
+    ``lastrecorder.radio.detach_socket``) to the pool
+    '''
+    r = res.fp._sock
+    if isinstance(r, PooledHTTPResponse):
+        r.length = 0
+    res.close()
@@ -1,2 +1,6 @@
 class SkipTrack(BaseException):
     pass
+
+
+class StopRecording(BaseException):
+    pass
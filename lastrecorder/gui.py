@@ -26,7 +26,7 @@ import pygtk
 pygtk.require("2.0")
 import gtk
 
-from gobject import idle_add
+from gobject import idle_add, timeout_add
 
 gtk.gdk.threads_init()
 
@@ -35,10 +35,17 @@ import lastrecorder
 from lastrecorder import NAME, AUTHORS, DISPLAY_NAME, IS_WINDOWS
 from lastrecorder.exceptions import SkipTrack
 from lastrecorder.radio import (RadioClient, HandshakeError, InvalidURL,
-                                NoContentAvailable, AdjustError)
+                                NoContentAvailable, AdjustError,
+                                SessionRejected)
+from lastrecorder.asyncradio import AsyncRadioClient
+from lastrecorder.catalog import open_catalog
+from lastrecorder.session import SessionCache
 from lastrecorder import util
 from lastrecorder import release
 
+# Seconds to wait for radio thread on exit
+RADIO_STOP_TIMEOUT = 5
+
 class RecordStopButton(gtk.Button):
     def __init__(self, *args, **kw):
         super(RecordStopButton, self).__init__(*args, **kw)
@@ -87,17 +94,27 @@ class GUI(object):
     class LoopBreak(BaseException):
         pass
 
+    # Milliseconds between progress bar updates
+    progress_interval = 100
+
     def __init__(self, config, options, urls):
         self.log = log = logging.getLogger(self.__class__.__name__)
         log.debug('config: %s', dict(config))
-        log.debug('options: %s', vars(options))
+        log.debug('options: %s', dict(vars(options)))
         self.config = config
         self.options = options
         self.urls = urls
-        self.radio_client = RadioClient()
-        self.break_loop = False
-        self.skip_track = False
+        catalog = open_catalog(lastrecorder.CATALOG)
+        sessions = SessionCache(lastrecorder.SESSIONS)
+        if options.event_loop:
+            self.radio_client = AsyncRadioClient(catalog=catalog,
+                                                 sessions=sessions)
+        else:
+            self.radio_client = RadioClient(catalog=catalog,
+                                            sessions=sessions)
         self.radio_thread = None
+        # Latest (track name, position, length) from the radio thread
+        self.progress_state = util.LatestValue()
 
         self.builder = builder = gtk.Builder()
         filename = '%s.glade' % NAME
@@ -163,6 +180,7 @@ class GUI(object):
         self.init_view()
         self.connect_signals()
         self.window.show()
+        timeout_add(self.progress_interval, self.update_progress)
 
     def connect_signals(self):
         self.outdir.connect('current_folder_changed',
@@ -201,6 +219,7 @@ class GUI(object):
         self.radio_thread.daemon = True
 
     def init_progress(self):
+        self.progress_state.clear()
         self.progress.set_text('Idle')
         self.progress.set_fraction(0)
 
@@ -290,7 +309,7 @@ class GUI(object):
             self.config.clear_password()
 
     def update_config(self):
-        self.log.debug('Options: %s', vars(self.options))
+        self.log.debug('Options: %s', dict(vars(self.options)))
         for field in ['skip_existing', 'strip_windows_incompat',
                       'strip_spaces', 'save', 'outdir', 'username']:
             value = getattr(self.options, field)
@@ -322,24 +341,36 @@ class GUI(object):
             self.log.exception('loop: %s', e)
         else:
             idle_add(self.init_record)
+        finally:
+            # Recordings left to tag and move are removed with temporary
+            # files unless they are saved first
+            self.radio_client.postprocessor.join()
+            idle_add(self.radio_finished)
+
+    def radio_finished(self):
+        '''Clean up after radio thread in GUI thread
+        '''
+        self.radio_thread = None
+        self.radio_client.remove_temp_files()
+        self.record_stop.set_sensitive(True)
 
     def handle_radio(self):
         log = self.log
         url = self.station_url
         radio = self.radio_client
 
-        idle_add(self.update_status, 'Logging in ...')
-        radio.handshake()
-        idle_add(self.update_status, '')
-        if self.break_loop:
-            raise self.LoopBreak
+        # Username might have changed since previous recording. Sessions
+        # saved by previous runs are looked up by username in tune().
+        radio.session = radio.tuned_url = None
+        radio.prefetch = None
+        radio.recover_temp_files()
+        rejected = False
 
         while True:
-            if self.break_loop:
-                raise self.LoopBreak
+            self.check_break()
             idle_add(self.update_status, 'Tuning to %s ...' % url)
             try:
-                radio.adjust(url)
+                radio.tune(url)
             except InvalidURL, e:
                 idle_add(self.update_status, e)
                 idle_add(self.station.grab_focus)
@@ -365,20 +396,22 @@ class GUI(object):
             finally:
                 idle_add(self.grab_default)
 
-            delay = util.BackoffDelay()
-            while True:
-                if self.break_loop:
-                    raise self.LoopBreak
+            self.check_break()
 
+            if radio.prefetch is None:
                 idle_add(self.update_status, 'Requesting tracks ...')
-                try:
-                    radio.xspf()
-                except urllib2.HTTPError, e:
-                    if e.code == 503:
-                        delay.sleep()
-                else:
-                    idle_add(self.update_status, '')
-                    break
+            try:
+                radio.next_tracks(self.check_break)
+            except SessionRejected, e:
+                if rejected:
+                    idle_add(self.update_status,
+                             'Failed to get playlist: %s' % e)
+                    return
+                rejected = True
+                radio.forget_session()
+                continue
+            rejected = False
+            idle_add(self.update_status, '')
 
             radio.handle_tracks()
 
@@ -390,32 +423,39 @@ class GUI(object):
         self.login.set_expanded(True)
         self.password.grab_focus()
 
+    def check_break(self):
+        # Skipping is left for the next track
+        self.radio_client.cancel.check(once=False)
+
     def check_falgs(self):
-        if self.break_loop:
-            self.break_loop = False
-            raise self.LoopBreak
-        if self.skip_track:
-            self.skip_track = False
-            raise SkipTrack
+        # Raises LoopBreak on every call once stopped so that every
+        # recording worker stops. SkipTrack is raised once.
+        self.radio_client.cancel.check()
 
     def progress_cb(self, track, position, length):
         self.check_falgs()
-        fraction = float(position) / float(length)
-        percent = fraction * 100
-        msg = '%s: %0.1f%%' % (track.name, percent)
-        idle_add(self.progress.set_fraction, fraction)
-        idle_add(self.progress.set_text, msg)
-
-    def read_cb(self):
-        self.check_falgs()
+        # Called for every chunk read. Just keep the latest state here,
+        # update_progress shows it at a fixed rate.
+        self.progress_state.put((track.name, position, length))
+
+    def update_progress(self):
+        state = self.progress_state.take()
+        if state is not None:
+            name, position, length = state
+            fraction = float(position) / float(length)
+            self.progress.set_fraction(fraction)
+            self.progress.set_text('%s: %0.1f%%' % (name, fraction * 100))
+        return True
 
     def track_start_cb(self, track):
         self.check_falgs()
+        self.progress_state.clear()
         idle_add(self.progress.set_text, track.name)
         idle_add(self.update_status, track.name)
 
     def track_end_cb(self, track):
         self.check_falgs()
+        self.progress_state.clear()
         idle_add(self.init_progress)
         idle_add(self.update_status, '')
 
@@ -424,9 +464,8 @@ class GUI(object):
         idle_add(self.update_status, 'Skipped %s' % track.name)
 
     def on_window_destroy(self, widget, data=None):
-        self.break_loop = True
-        if self.radio_thread is not None and self.radio_thread.isAlive():
-            self.radio_thread.join()
+        # Radio thread is waited for in gui_main after the main loop exits
+        self.radio_client.cancel.cancel(self.LoopBreak)
         self.update_password()
         self.update_config()
         self.write_config()
@@ -436,25 +475,28 @@ class GUI(object):
         record_stop = widget
         if record_stop.is_record:
             for name in ['username', 'passwordmd5', 'outdir', 'skip_existing',
-                         'strip_windows_incompat', 'strip_spaces']:
+                         'strip_windows_incompat', 'strip_spaces', 'jobs']:
                 value = getattr(self.options, name)
                 setattr(self.radio_client, name, value)
+            self.radio_client.write_buffer = self.options.write_buffer * 1024
+            self.radio_client.path_template = self.options.template
+            self.radio_client.min_rate = self.options.min_rate * 1024
+            self.radio_client.stall_window = self.options.stall_window
             self.radio_client.progress_cb = self.progress_cb
             self.radio_client.track_start_cb = self.track_start_cb
             self.radio_client.track_end_cb = self.track_end_cb
             self.radio_client.track_skip_cb = self.track_skip_cb
-            self.radio_client.read_cb = self.read_cb
-            self.break_loop = False
-            self.skip_track = False
+            self.radio_client.cancel.reset()
             self.init_radio_thread()
             self.radio_thread.start()
         else:
+            # Don't wait for the radio thread here. It stops as soon as it
+            # sees the cancellation and radio_finished() enables the button
+            # again.
             self.init_record()
-            self.break_loop = True
+            self.radio_client.cancel.cancel(self.LoopBreak)
             if self.radio_thread is not None:
-                self.radio_thread.join()
-            self.radio_thread = None
-            self.radio_client.remove_temp_files()
+                self.record_stop.set_sensitive(False)
             self.url_status_message()
 
         record_stop.toggle()
@@ -466,8 +508,7 @@ class GUI(object):
 
     def on_next_clicked(self, widget, data=None):
         if self.radio_thread is not None and self.radio_thread.isAlive():
-            self.skip_track = True
-            self.radio_client.remove_temp_files()
+            self.radio_client.cancel.cancel(SkipTrack, once=True)
             self.init_progress()
 
     def on_username_changed(self, widget, data=None):
@@ -560,3 +601,7 @@ def gui_main(config=None, options=None, urls=None):
     gtk.gdk.threads_enter()
     gtk.main()
     gtk.gdk.threads_leave()
+    # Let cancelled radio thread remove its temporary files
+    thread = gui.radio_thread
+    if thread is not None:
+        thread.join(RADIO_STOP_TIMEOUT)
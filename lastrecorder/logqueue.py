@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Logging from a background thread.
+
+``QueueHandler`` only puts log records on a queue, so a thread that logs
+doesn't wait for the log file or the terminal. ``QueueListener`` takes
+the records off in its own thread, formats them and passes them to the
+real handlers. Python 2 logging has neither, they follow the interface of
+the ones added to ``logging.handlers`` in Python 3.2.
+
+Records are formatted after the logging call returns. Arguments must not
+change afterwards: pass copies of dicts and lists that do.
+'''
+
+from __future__ import with_statement
+import logging
+import threading
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    # Put on the queue to stop the listener thread
+    sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            # Daemon so that records logged at shutdown don't keep the
+            # interpreter waiting, stop() is meant to be called atexit
+            self.thread = threading.Thread(name='log', target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        '''Handle records queued so far and stop the listener thread
+        '''
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.queue.put(self.sentinel)
+        thread.join()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self.sentinel:
+                return
+            self.handle(record)
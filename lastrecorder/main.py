@@ -18,7 +18,7 @@
   %prog --help
 
 Features:
-  * <artist>/<album>/<title> file naming scheme
+  * <artist>/<album>/<title> file naming scheme (see --path-template)
   * Automatic ID3 tags
   * Skipping previously recorded tracks (optional)
   * Stripping Windows-incompatible characters and/or spaces from paths
@@ -28,21 +28,33 @@ Features:
 Examples:
   %prog lastfm://usertags/liago0sh/positive
   %prog -s "lastfm://usertags/liago0sh/heavy electro" -d
+  %prog -m lastfm://globaltags/jazz work=lastfm://globaltags/blues
+
+With --multi every URL is recorded at the same time. Prefix URL with
+NAME= to use credentials from "[account NAME]" section of config file.
 '''
 import os
 import sys
+import atexit
 import socket
 import getpass
 import httplib
 import logging
 import logging.handlers
+import Queue
 
 from optparse import OptionParser
 
+from lastrecorder import metrics
 from lastrecorder import util
+from lastrecorder.logqueue import QueueHandler, QueueListener
 from lastrecorder.radio import RadioClient, HandshakeError, setup_urllib2
+from lastrecorder.catalog import open_catalog, DatabaseError
+from lastrecorder.session import SessionCache
 from lastrecorder.config import Config
-from lastrecorder import LOGFILE, IS_WINDOWS, CONFIGDIR, MUSICDIR, DEFAULTS
+from lastrecorder.template import PathTemplate, TemplateError
+from lastrecorder import (LOGFILE, IS_WINDOWS, CONFIGDIR, MUSICDIR, CATALOG,
+                          SESSIONS, DEFAULTS)
 from lastrecorder import release
 
 
@@ -64,6 +76,10 @@ def parse_args(config, defaults):
                       help='Last.fm password MD5 hex digest')
     parser.add_option('--debug', '-d', dest='debug', action='store_true',
                       help='verbose log messages')
+    parser.add_option('--no-log-queue', dest='log_queue',
+                      action='store_false',
+                      help=("write log messages from the thread logging them"
+                            " instead of a background thread"))
     parser.add_option('--no-save-credentials', '-n', dest='save',
                       action='store_false',
                       help="don't save Last.fm user and encrypted password")
@@ -80,16 +96,71 @@ def parse_args(config, defaults):
     parser.add_option('--no-strip-spaces', '-s', dest='strip_spaces',
                       action='store_false',
                       help="don't replace space characters with underscores")
+    parser.add_option('--path-template', '-t', dest='path_template',
+                      action='store',
+                      help=('track file path in output directory made of'
+                            ' fields artist, album and title, e.g.'
+                            ' {artist:.1}/{artist}/{album}/{title}.mp3'
+                            ' [default: %s]') % defaults['path_template'])
+    parser.add_option('--jobs', '-j', dest='jobs', action='store', type='int',
+                      help=('number of playlist tracks to record at once'
+                            ' [default: %s]') % defaults['jobs'])
+    parser.add_option('--write-buffer', dest='write_buffer', action='store',
+                      type='int',
+                      help=('size of track file write buffer in KiB'
+                            ' [default: %s]') % defaults['write_buffer'])
+    parser.add_option('--min-rate', dest='min_rate', action='store',
+                      type='int',
+                      help=('abort track streams slower than this many KiB/s,'
+                            ' 0 to disable [default: %s]') %
+                      defaults['min_rate'])
+    parser.add_option('--stall-window', dest='stall_window', action='store',
+                      type='int',
+                      help=('seconds a stream may stay below --min-rate'
+                            ' [default: %s]') % defaults['stall_window'])
+    parser.add_option('--event-loop', '-l', dest='event_loop',
+                      action='store_true',
+                      help=('record tracks on a single event loop instead of'
+                            ' a thread per track'))
+    parser.add_option('--multi', '-m', dest='multi', action='store_true',
+                      help='record all given stations at once')
+    parser.add_option('--metrics-file', dest='metrics_file', action='store',
+                      help=('write recording metrics to this file in'
+                            ' Prometheus text format'))
+    parser.add_option('--metrics-port', dest='metrics_port', action='store',
+                      type='int',
+                      help=('serve recording metrics at'
+                            ' http://127.0.0.1:PORT/metrics'))
+    parser.add_option('--rescan', '-r', dest='rescan', action='store_true',
+                      help=('rebuild catalog of recorded tracks from output'
+                            ' directory'))
 
     options, args = parser.parse_args()
 
     # Quote URLs
     if options.quote:
-        args = [ util.quote_url(arg) for arg in args ]
+        args = [ quote_station(arg) for arg in args ]
 
     return parser, options, args
 
 
+def split_station(arg):
+    '''Split NAME=URL station argument. Returns (NAME or None, URL)
+    '''
+    account, sep, url = arg.partition('=')
+    if not sep or ':' in account:
+        return None, arg
+    return account, url
+
+
+def quote_station(arg):
+    account, url = split_station(arg)
+    url = util.quote_url(url)
+    if account is None:
+        return url
+    return '%s=%s' % (account, url)
+
+
 def setup_logging(options):
     level = logging.INFO
     if options.debug:
@@ -102,15 +173,24 @@ def setup_logging(options):
     format = '%(asctime)s %(levelname)8s %(name)s: %(message)s'
     formatter = logging.Formatter(format)
     handler.setFormatter(formatter)
-    root = logging.getLogger()
-    root.setLevel(level)
-    root.addHandler(handler)
+    handlers = [handler]
     # Console logger
     if not IS_WINDOWS:
         handler = logging.StreamHandler(sys.stderr)
         handler.setLevel(logging.DEBUG)
         handler.setFormatter(formatter)
-        root.addHandler(handler)
+        handlers.append(handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    if options.log_queue:
+        # Keep file and terminal I/O off recording threads
+        listener = QueueListener(Queue.Queue(), *handlers)
+        root.addHandler(QueueHandler(listener.queue))
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            root.addHandler(handler)
 
 
 def progress_cb(track, position, length):
@@ -121,7 +201,10 @@ def progress_cb(track, position, length):
 
 
 def setup(defaults):
-    reload(sys).setdefaultencoding('utf-8')
+    # Track names mix byte and unicode strings. site.py hides
+    # setdefaultencoding, reload(sys) brings it back.
+    if sys.getdefaultencoding() != 'utf-8':
+        reload(sys).setdefaultencoding('utf-8')
     for d in [CONFIGDIR, MUSICDIR]:
         if not os.path.exists(d):
             os.makedirs(d)
@@ -133,21 +216,29 @@ def setup(defaults):
     setup_logging(options)
     log = logging.getLogger('setup')
 
-    try:
-        import pygtk
-    except ImportError:
-        pygtk = None
-    try:
-        import mutagen
-    except ImportError:
-        mutagen = None
+    # Only check that the libraries are there. They are imported when
+    # they are used for the first time.
+    pygtk = util.LazyModule('pygtk')
+    mutagen = util.LazyModule('mutagen')
 
-    if options.gui and not pygtk:
+    if options.gui and not pygtk.available():
         options.gui = False
         log = logging.getLogger('main')
         log.warn('pygtk library not found. GUI disabled.')
-    if not mutagen:
+    if not mutagen.available():
         log.warn('mutagen library not found. Tagging disabled.')
+    if options.jobs < 1:
+        parser.error('--jobs must be a positive number')
+    if options.write_buffer < 0:
+        parser.error('--write-buffer must not be negative')
+    try:
+        options.template = PathTemplate(options.path_template)
+    except TemplateError, e:
+        parser.error(str(e))
+    if options.min_rate < 0:
+        parser.error('--min-rate must not be negative')
+    if options.stall_window < 1:
+        parser.error('--stall-window must be a positive number')
     if not options.gui and not urls:
         parser.error('Please specify lastfm:// URL')
     if not os.path.exists(options.outdir):
@@ -158,6 +249,36 @@ def setup(defaults):
     return config, options, urls
 
 
+def start_metrics(options):
+    '''Start metrics exporters requested in `options`. Returns list of
+    started exporters
+    '''
+    log = logging.getLogger('main')
+    exporters = []
+    if options.metrics_file:
+        writer = metrics.TextfileWriter(options.metrics_file)
+        writer.start()
+        exporters.append(writer)
+    if options.metrics_port:
+        try:
+            server = metrics.MetricsServer(options.metrics_port)
+        except socket.error, e:
+            log.error('Cannot serve metrics on port %s: %s',
+                      options.metrics_port, e)
+        else:
+            server.start()
+            exporters.append(server)
+    return exporters
+
+
+def stop_metrics(exporters):
+    for exporter in exporters:
+        if isinstance(exporter, metrics.TextfileWriter):
+            exporter.stop()
+        else:
+            exporter.shutdown()
+
+
 def getpassword(username):
     password = None
     while not password:
@@ -194,11 +315,22 @@ def cli_main(config=None, options=None, urls=None):
     return main(config, options, urls)
 
 
+def gui_main(config=None, options=None, urls=None):
+    '''GUI entry point. Falls back to command line interface without
+    importing GTK if GUI is disabled or not available
+    '''
+    if config is None:
+        DEFAULTS['gui'] = True
+        config, options, urls = setup(DEFAULTS.copy())
+    return main(config, options, urls)
+
+
 def main(config=None, options=None, urls=None):
     if config is None:
         config, options, urls = setup(DEFAULTS.copy())
 
     log = logging.getLogger('main')
+    exporters = start_metrics(options)
     try:
         if options.gui:
             try:
@@ -219,10 +351,52 @@ def main(config=None, options=None, urls=None):
             except (IOError, OSError), e:
                 log.exception('Error saving config file: %s', e)
 
-        radio_client = RadioClient(username, passwordmd5, options.outdir,
-                                   options.strip_windows_incompat,
-                                   options.strip_spaces, options.skip_existing,
-                                   progress_cb)
+        catalog = open_catalog(CATALOG)
+        if catalog is not None and options.rescan:
+            try:
+                catalog.import_outdir(options.outdir, force=True)
+            except DatabaseError, e:
+                log.exception('Error importing %s: %s', options.outdir, e)
+
+        sessions = SessionCache(SESSIONS)
+        client_class = RadioClient
+        if options.event_loop:
+            from lastrecorder.asyncradio import AsyncRadioClient
+            client_class = AsyncRadioClient
+        def make_client(username, passwordmd5, progress_cb=None):
+            client = client_class(username, passwordmd5, options.outdir,
+                                  options.strip_windows_incompat,
+                                  options.strip_spaces, options.skip_existing,
+                                  progress_cb, options.jobs, catalog,
+                                  sessions)
+            client.write_buffer = options.write_buffer * 1024
+            client.path_template = options.template
+            client.min_rate = options.min_rate * 1024
+            client.stall_window = options.stall_window
+            return client
+
+        if options.multi:
+            from lastrecorder.stations import Station, MultiRecorder
+            accounts = config.accounts()
+            stations = []
+            for arg in urls:
+                account, url = split_station(arg)
+                credentials = (username, passwordmd5)
+                if account is not None:
+                    if account not in accounts:
+                        log.error('No [account %s] section in %s', account,
+                                  config.filename)
+                        return 1
+                    credentials = accounts[account]
+                stations.append(Station(url, make_client(*credentials)))
+            try:
+                MultiRecorder(stations).run()
+            except KeyboardInterrupt:
+                log.info('Interrupted. Exiting.')
+            return
+
+        urls = [ split_station(arg)[1] for arg in urls ]
+        radio_client = make_client(username, passwordmd5, progress_cb)
         try:
             radio_client.loop(urls)
         except HandshakeError, e:
@@ -240,6 +414,8 @@ def main(config=None, options=None, urls=None):
     except Exception, e:
         log.exception(e)
         return 1
+    finally:
+        stop_metrics(exporters)
 
 
 if __name__ == '__main__':
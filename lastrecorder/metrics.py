@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Counters, gauges and histograms in Prometheus text format.
+
+Metrics are registered in ``registry`` and exported either by writing a
+text file periodically (``TextfileWriter``, e.g. for node_exporter's
+textfile collector) or by serving it over HTTP (``MetricsServer``).
+'''
+
+import BaseHTTPServer
+import logging
+import os
+import tempfile
+import threading
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+THROUGHPUT_BUCKETS = (4e3, 8e3, 16e3, 32e3, 64e3, 128e3, 256e3, 1e6, 10e6)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = [ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+              for k, v in labels ]
+    return '{%s}' % ','.join(pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        self.lock.acquire()
+        try:
+            lines.extend(self.samples())
+        finally:
+            self.lock.release()
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        return [ '%s%s %s' % (self.name, format_labels(k), format_value(v))
+                 for k, v in sorted(self.values.items()) ]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            counts, total = self.values.get(key,
+                                            ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+        finally:
+            self.lock.release()
+
+    def samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = key + (('le', format_value(bound)),)
+                lines.append('%s_bucket%s %d' % (self.name,
+                                                 format_labels(labels), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(key),
+                                          format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(key),
+                                            counts[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help):
+        metric = Gauge(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class TextfileWriter(object):
+    '''Write `registry` to `path` every `interval` seconds and at exit
+    '''
+    def __init__(self, path, interval=15, registry=registry):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(name='metrics', target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.write()
+            self.stopped.wait(self.interval)
+
+    def write(self):
+        # Write and rename so that readers never see a partial file
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.metrics.')
+            fp = os.fdopen(fd, 'w')
+            try:
+                fp.write(self.registry.render())
+            finally:
+                fp.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            self.log.error('Cannot write %s: %s', self.path, e)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('MetricsServer').debug(format, *args)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    '''Serve metrics at http://`host`:`port`/metrics from a background
+    thread
+    '''
+    def __init__(self, port, host='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.thread = threading.Thread(name='metrics',
+                                       target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
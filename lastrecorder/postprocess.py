@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Finishing recorded tracks in the background.
+
+Tagging a recording and moving it into place takes a while on slow disks.
+``PostProcessor`` runs such tasks in a small pool of threads so that the
+recording thread can request the next stream right away. Threads rather
+than processes because tasks share the catalog and the client's temporary
+file bookkeeping.
+'''
+
+from __future__ import with_statement
+import collections
+import logging
+import threading
+import time
+
+from lastrecorder import metrics
+
+POSTPROCESS_WORKERS = 2
+
+QUEUE_LENGTH = metrics.registry.gauge(
+    'lastrecorder_postprocess_queue_length',
+    'Recorded tracks waiting to be tagged and moved into place')
+TASK_SECONDS = metrics.registry.histogram(
+    'lastrecorder_postprocess_seconds',
+    'Time taken to tag and move a recorded track')
+
+
+class PostProcessor(object):
+    def __init__(self, workers=POSTPROCESS_WORKERS):
+        self.workers = workers
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.tasks = collections.deque()
+        # Number of queued or running tasks by key
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def submit(self, key, func, *args):
+        '''Call `func` with `args` in a worker thread. `key` identifies the
+        task for `is_pending`
+        '''
+        with self.cond:
+            self.tasks.append((key, func, args))
+            self.pending[key] = self.pending.get(key, 0) + 1
+            QUEUE_LENGTH.inc()
+            if len(self.threads) < self.workers:
+                t = threading.Thread(name='postprocess-%d' % len(self.threads),
+                                     target=self.run)
+                t.daemon = True
+                self.threads.append(t)
+                t.start()
+
+    def is_pending(self, key):
+        with self.cond:
+            return key in self.pending
+
+    def join(self):
+        '''Wait until all submitted tasks are done
+        '''
+        with self.cond:
+            while self.pending:
+                # Wait with timeout so that KeyboardInterrupt gets through
+                self.cond.wait(0.5)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.tasks:
+                    # Idle workers exit so that none is left blocked at
+                    # interpreter shutdown
+                    self.threads.remove(threading.currentThread())
+                    return
+                key, func, args = self.tasks.popleft()
+            QUEUE_LENGTH.dec()
+            started = time.time()
+            try:
+                func(*args)
+            except Exception, e:
+                self.log.exception('%s: %s', func.__name__, e)
+            finally:
+                TASK_SECONDS.observe(time.time() - started)
+                with self.cond:
+                    self.pending[key] -= 1
+                    if not self.pending[key]:
+                        del self.pending[key]
+                    self.cond.notifyAll()
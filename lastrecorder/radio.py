@@ -13,41 +13,98 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import atexit
+import collections
+import errno
 import httplib
 import logging
 import os
+import Queue
 import select
-import shutil
 import socket
+import sys
 import tempfile
+import threading
 import time
 import urllib2
-import xml.sax
+import urlparse
 
 from pprint import pformat
+from xml.parsers import expat
 
-try:
-    import mutagen
-except ImportError:
-    mutagen = None
 from lastrecorder.exceptions import SkipTrack
+from lastrecorder.cancel import CancelToken
+from lastrecorder.catalog import DatabaseError
+from lastrecorder import connpool
+from lastrecorder import metrics
 from lastrecorder import util
+from lastrecorder.postprocess import PostProcessor
+from lastrecorder.template import (WINDOWS_INCOMPAT, default_template,
+                                   filename_template, replace_chars)
+from lastrecorder.writer import FileWriter
+
+# Imported when the first track is tagged
+mutagen = util.LazyModule('mutagen')
 
 SOCKET_READ_SIZE = 512
+READ_BUFFER_MIN = 4 * 1024
+READ_BUFFER_MAX = 256 * 1024
 SOCKET_TIMEOUT = 30
+# Streams slower than MIN_STREAM_RATE bytes per second over last
+# STALL_WINDOW seconds are aborted
+MIN_STREAM_RATE = 4 * 1024
+STALL_WINDOW = 30
+# Default buffer size of track files
+WRITE_BUFFER = 1024 * 1024
+# Room left in ID3 header written before audio data for later tag updates
+ID3_PADDING = 1024
+# Times to resume interrupted track stream and seconds to wait before that
+RESUME_ATTEMPTS = 3
+RESUME_DELAY = 2
+# Track metadata strings shared between tracks, see intern_string()
+STRING_POOL_SIZE = 10000
+string_pool = {}
+# Recent tracks remembered for status and to skip repeated ones
+HISTORY_SIZE = 100
 # Pretend to be Last.fm player
 VERSION = '1.5.1.31879'
 USER_AGENT = 'User-Agent: Last.fm Client %s (X11)' % VERSION
 
+REQUEST_SECONDS = metrics.registry.histogram(
+    'lastrecorder_request_seconds',
+    'Latency of handshake, adjust and xspf requests')
+FIRST_BYTE_SECONDS = metrics.registry.histogram(
+    'lastrecorder_stream_first_byte_seconds',
+    'Time from requesting a track stream to its first audio byte')
+STREAM_BYTES_PER_SECOND = metrics.registry.histogram(
+    'lastrecorder_stream_bytes_per_second',
+    'Track stream throughput', metrics.THROUGHPUT_BUCKETS)
+STREAM_BYTES = metrics.registry.counter(
+    'lastrecorder_stream_bytes_total', 'Audio bytes received')
+TRACKS = metrics.registry.counter(
+    'lastrecorder_tracks_total', 'Tracks recorded, skipped or failed')
+STREAM_ABORTS = metrics.registry.counter(
+    'lastrecorder_stream_aborts_total',
+    'Track streams aborted before the end by reason')
+BACKOFF_SECONDS = metrics.registry.counter(
+    'lastrecorder_backoff_seconds_total',
+    'Time spent waiting after 503 responses')
+
 class Error(Exception):
     pass
 
+class ResumeError(IOError):
+    pass
+
+
 class HandshakeError(Error):
     pass
 
 class SessionError(Error):
     pass
 
+class SessionRejected(SessionError):
+    pass
+
 class AdjustError(Error):
     pass
 
@@ -67,120 +124,289 @@ class NoContentAvailable(Error):
     pass
 
 
-class Track(dict):
+def intern_string(value):
+    '''Returns the pooled string equal to `value` (of the same type) so
+    that tracks of one artist or album share it. The pool is emptied when
+    it gets full to stay bounded in long sessions.
+    '''
+    key = (value.__class__, value)
+    pooled = string_pool.get(key)
+    if pooled is None:
+        if len(string_pool) >= STRING_POOL_SIZE:
+            string_pool.clear()
+        pooled = string_pool[key] = value
+    return pooled
+
+
+class Track(object):
+    '''Playlist entry. Only fields needed to record and name the track are
+    kept out of everything XSPF has. They are attributes, also readable as
+    items (track['title']) with 'artist' standing for 'creator'.
+    '''
+    __slots__ = ('location', 'title', 'album', 'creator', 'paths')
+    fields = ('location', 'title', 'album', 'creator')
+
     def __init__(self, *args, **kw):
-        super(Track, self).__init__(*args, **kw)
-        self.log = logging.getLogger(self.__class__.__name__)
-        if not self.get('location'):
+        data = dict(*args, **kw)
+        self.location = data.get('location')
+        if not self.location:
             raise ValueError('Bad track data: no stream location defined')
         default = '[unknown]'
         for key in 'title album creator'.split():
-            if not self.get(key):
-                self[key] = default
-        self['artist'] = self['creator']
+            setattr(self, key, intern_string(data.get(key) or default))
+        # Rendered paths by template and naming options
+        self.paths = None
+
+    def __getitem__(self, key):
+        if key == 'artist':
+            key = 'creator'
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            [ '%s=%r' % (key, getattr(self, key)) for key in self.fields ]))
+
+    @property
+    def artist(self):
+        return self.creator
 
     def strip_windows_incompat(self, string, substitute='_'):
         '''Strip Windows-incompatible characters.
         '''
-        s = substitute
-        string = ''.join([ ((c in '\/:*?;"<>|' and s) or c) for c in string ])
-        # Remove trailnig dots and spaces
-        # http://mail.python.org/pipermail/python-list/2005-July/330549.html
-        if s.endswith('.') or s.endswith(' '):
-            string[-1] = s
-        return string
+        return replace_chars(string, WINDOWS_INCOMPAT, substitute)
 
-    def getpath(self, strip_windows_incompat=False, strip_spaces=False):
-        '''Get relative path to track file based on its metadata
-        <artist>/<album>/<title>
+    def getpath(self, strip_windows_incompat=False, strip_spaces=False,
+                template=None):
+        '''Get relative path to track file based on its metadata and
+        `template` (PathTemplate, <artist>/<album>/<title>.mp3 by default).
+        Paths are computed once per track.
         '''
-        sep = os.path.sep
-        data = self.copy()
-        for key in 'title album creator'.split():
-            value = data[key]
-            if strip_windows_incompat:
-                value = self.strip_windows_incompat(value)
-            if strip_spaces:
-                value = value.replace(' ', '_') 
-            value = value.replace(sep, '-')
-            data[key] = value
-
-        artist, album, title = data['creator'], data['album'], data['title']
-        dirpath = os.path.join(artist, album)
-        filepath = os.path.join(dirpath, '%s.mp3' % title)
-        return filepath
+        if template is None:
+            template = default_template
+        key = (template.template, strip_windows_incompat, strip_spaces)
+        if self.paths is None:
+            self.paths = {}
+        path = self.paths.get(key)
+        if path is None:
+            path = template.render(self, strip_windows_incompat,
+                                   strip_spaces)
+            self.paths[key] = path
+        return path
 
     def make_filename(self):
-        data = self.copy()
-        sep = os.path.sep
-        for key in 'title creator'.split():
-            value = data[key]
-            value = self.strip_windows_incompat(value)
-            value = value.replace(' ', '_') 
-            value = value.replace(sep, '-')
-            data[key] = value
-
-        artist, title = data['creator'], data['title']
-        filepath = '%s_-_%s.mp3' % (artist, title)
-        return filepath
-
-    def find_existing(self, directory):
+        return self.getpath(True, True, filename_template)
+
+    def find_existing(self, directory, template=None):
         '''Find existing files for this track checking all possible naming
         schemes. Returns first matched path
         '''
-        # Get list of all possible binary combinations of given length
-        l = 2
-        masks = [ 1 << i - 1 for i in range(l, 0, -1) ]
-        binary_combinations = [ map(lambda x: bool(x & i), masks)
-                                for i in range(1 << l) ]
-        for args in binary_combinations:
-            path = os.path.join(directory, self.getpath(*args))
+        checked = set()
+        for args in [(False, False), (False, True), (True, False),
+                     (True, True)]:
+            path = self.getpath(*args, template=template)
+            if path in checked:
+                continue
+            checked.add(path)
+            path = os.path.join(directory, path)
             if os.path.exists(path):
                 return path
         return None
 
     @property
     def name(self):
-        return '%(creator)s — %(title)s' % self
+        return '%s — %s' % (self.creator, self.title)
+
+
+def track_names(tracks):
+    return ''.join([ '%s\n' % t.name for t in tracks ])
 
 
-class XSPFHandler(xml.sax.ContentHandler):
-    '''XSPF playilst parser. Saves tracks into ``self.tracks`` as ``dict``s 
+class XSPFParser(object):
+    '''Streaming XSPF playlist parser. Saves tracks into ``self.tracks`` as
+    ``dict``s
     '''
     def __init__(self):
-        self.depth = -1
-        self.indent = '  '
         self.log = logging.getLogger(self.__class__.__name__)
-        self.data = ''
+        self.debug = self.log.isEnabledFor(logging.DEBUG)
+        self.depth = -1
+        self.data = []
         self.tracks = []
         self.track = None
         self.track_attr = None
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.characters
+
+    def parse(self, fp):
+        self.parser.ParseFile(fp)
+        return self.tracks
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
 
-    def startElement(self, name, attrs):
+    def start_element(self, name, attrs):
         self.depth += 1
-        i = self.indent
-        a = [ '%s=%s' % item for item in attrs.items()]
-        self.log.debug('%s+%s %s', i * self.depth, name, a)
+        if self.debug:
+            self.log.debug('%s+%s %s', '  ' * self.depth, name, attrs)
         if self.depth == 2 and name == 'track':
             self.track = dict()
-        if self.depth == 3 and self.track is not None:
+        elif self.depth == 3 and self.track is not None:
             self.track_attr = name
             self.track.setdefault(name, None)
+            self.data = []
 
     def characters(self, data):
-        self.data += data
+        if self.depth == 3:
+            self.data.append(data)
 
-    def endElement(self, name):
-        i = self.indent
-        data = self.data.strip()
-        self.log.debug('%s %s', i * self.depth, data)
+    def end_element(self, name):
         if self.depth == 3 and self.track_attr is not None:
+            data = ''.join(self.data).strip()
+            if self.debug:
+                self.log.debug('%s %s', '  ' * self.depth, data)
             self.track[self.track_attr] = data
-        if self.depth == 2 and name == 'track':
+            self.track_attr = None
+        elif self.depth == 2 and name == 'track':
             self.tracks.append(self.track)
             self.track = None
         self.depth -= 1
-        self.data = ''
+
+
+class ReadBuffer(object):
+    '''Preallocated buffer for reading audio streams. Data is received
+    straight into the buffer and returned as ``memoryview`` (``buffer`` on
+    Python 2.6) slices that can be written to a file without copying. The
+    chunk size doubles while
+    reads fill it completely (the socket has more data queued than we ask
+    for) and halves when they fill less than a quarter of it.
+    '''
+    def __init__(self, min_size=READ_BUFFER_MIN, max_size=READ_BUFFER_MAX):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+        self.buffer = bytearray(max_size)
+        try:
+            self.view = memoryview(self.buffer)
+        except NameError:
+            # Python 2.6
+            self.view = None
+
+    def recv(self, sock):
+        '''Receive available data from `sock`. Returns ``memoryview`` or
+        ``buffer`` which is only valid until the next call
+        '''
+        n = sock.recv_into(self.buffer, self.size)
+        self.adjust(n)
+        if self.view is None:
+            return buffer(self.buffer, 0, n)
+        return self.view[:n]
+
+    def adjust(self, n):
+        if n >= self.size:
+            self.size = min(self.size * 2, self.max_size)
+        elif n < self.size // 4:
+            self.size = max(self.size // 2, self.min_size)
+
+
+class ThroughputWatchdog(object):
+    '''Rolling throughput of a stream. The stream is too slow once it has
+    been read for `window` seconds and received less than `min_rate` bytes
+    per second during the last `window` seconds. Zero `min_rate` disables
+    the check.
+    '''
+    def __init__(self, min_rate=MIN_STREAM_RATE, window=STALL_WINDOW):
+        self.min_rate = min_rate
+        self.window = window
+        # (time, total bytes) at most one per second
+        self.samples = collections.deque()
+        self.total = 0
+
+    def start(self, now=None):
+        if now is None:
+            now = time.time()
+        self.total = 0
+        self.samples.clear()
+        self.samples.append((now, 0))
+
+    def update(self, n, now=None):
+        if now is None:
+            now = time.time()
+        self.total += n
+        if now - self.samples[-1][0] >= 1:
+            self.samples.append((now, self.total))
+        # Keep the last sample older than the window as its start
+        limit = now - self.window
+        while len(self.samples) > 1 and self.samples[1][0] <= limit:
+            self.samples.popleft()
+
+    def check(self, now=None):
+        '''Returns the reason if the stream is too slow, otherwise
+        ``None``
+        '''
+        if not self.min_rate:
+            return
+        if now is None:
+            now = time.time()
+        self.update(0, now)
+        since, total = self.samples[0]
+        elapsed = now - since
+        if elapsed < self.window:
+            return
+        rate = (self.total - total) / elapsed
+        if rate < self.min_rate:
+            return ('%d bytes/s over last %d seconds, minimum is %d' %
+                    (rate, elapsed, self.min_rate))
+
+
+class Prefetch(object):
+    '''Call `func` in a background thread and keep the result until it is
+    asked for
+    '''
+    def __init__(self, func, *args, **kw):
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.thread = None
+        self.value = None
+        self.error = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(name='prefetch', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kw)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def result(self, wait_cb=None):
+        '''Wait for the result starting the call if needed. `wait_cb` is
+        called periodically while waiting. Exception raised by `func` is
+        re-raised here.
+        '''
+        self.start()
+        while self.thread.isAlive():
+            self.thread.join(0.5)
+            if wait_cb is not None:
+                wait_cb()
+        if self.error is not None:
+            exc_type, exc_value, tb = self.error
+            raise exc_type, exc_value, tb
+        return self.value
 
 
 class RadioClient(object):
@@ -194,21 +420,45 @@ class RadioClient(object):
 
     def __init__(self, username=None, passwordmd5=None, outdir=None,
                  strip_windows_incompat=False, strip_spaces=False,
-                 skip_existing=False, progress_cb=None):
+                 skip_existing=False, progress_cb=None, jobs=1,
+                 catalog=None, sessions=None):
         self.username = username
         self.passwordmd5 = passwordmd5
         self.outdir = outdir
         self.strip_windows_incompat = strip_windows_incompat
         self.strip_spaces = strip_spaces
         self.skip_existing = skip_existing
+        self.jobs = jobs
+        self.write_buffer = WRITE_BUFFER
+        # PathTemplate of track files in outdir
+        self.path_template = default_template
+        self.min_rate = MIN_STREAM_RATE
+        self.stall_window = STALL_WINDOW
+        self.catalog = catalog
+        # SessionCache to reuse sessions of previous runs
+        self.sessions = sessions
         if progress_cb is not None:
             self.progress_cb = progress_cb
 
         self.session = None
         self.station_name = None
+        # URL the session has been tuned to with adjust()
+        self.tuned_url = None
         self.tracks = None
+        self.prefetch = None
+        # Cancelled from other threads to stop or skip recording at once
+        self.cancel = CancelToken()
         self.log = logging.getLogger(self.__class__.__name__)
         self.temp_files = set()
+        self.temp_files_lock = threading.Lock()
+        # Partial recordings left by previous runs. See recover_temp_files()
+        self.partial_files = {}
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.history_lock = threading.Lock()
+        # Tags and moves recorded tracks while the next ones are recorded
+        self.postprocessor = PostProcessor()
+        # Functions called with track and its path once it has been saved
+        self.finish_hooks = []
         atexit.register(self.remove_temp_files)
 
     def progress_cb(self, track, position, length):
@@ -223,21 +473,43 @@ class RadioClient(object):
     def track_end_cb(self, track):
         pass
 
+    def track_error_cb(self, track):
+        pass
+
     def read_cb(self):
         pass
 
     def remove_temp_files(self):
-        for path in self.temp_files:
-            try:
-                os.unlink(path)
-            except (OSError, IOError):
-                pass
-        self.temp_files = set()
+        self.temp_files_lock.acquire()
+        try:
+            for path in self.temp_files:
+                try:
+                    os.unlink(path)
+                except (OSError, IOError):
+                    pass
+            self.temp_files = set()
+        finally:
+            self.temp_files_lock.release()
+
+    def add_temp_file(self, path):
+        self.temp_files_lock.acquire()
+        try:
+            self.temp_files.add(path)
+        finally:
+            self.temp_files_lock.release()
+
+    def discard_temp_file(self, path):
+        self.temp_files_lock.acquire()
+        try:
+            self.temp_files.discard(path)
+        finally:
+            self.temp_files_lock.release()
 
     def urlopen(self, *args, **kw):
         res = urllib2.urlopen(*args, **kw)
-        self.log.debug([res.code, res.msg])
-        self.log.debug('headers:\n%s' % ''.join(res.headers.headers))
+        self.log.debug('%s %s', res.code, res.msg)
+        self.log.debug('headers:\n%s',
+                       util.LazyString(''.join, res.headers.headers))
         return res
 
     def handshake(self):
@@ -248,12 +520,14 @@ class RadioClient(object):
         url = self.handshake_url % (VERSION, self.username, passwordmd5)
         log.debug('handshake_url: %s', url)
         log.info('Initiating handshake')
+        start = time.time()
         res = self.urlopen(url)
         try:
             vars = dict(self.parse_vars(res.fp))
         except ValueError, e:
             log.error('Bad server response: %s', e, exc_info=True)
-        log.debug('vars:\n%s' % pformat(vars))
+        REQUEST_SECONDS.observe(time.time() - start, request='handshake')
+        log.debug('vars:\n%s', util.LazyString(pformat, vars))
         try:
             self.session = vars['session']
         except KeyError, e:
@@ -271,12 +545,14 @@ class RadioClient(object):
         if not session:
             raise SessionError('No session. Call handshake() first.')
         log.info('Tunning to "%s"', url)
+        start = time.time()
         res = self.urlopen(self.adjust_url % (session, url))
         try:
             vars = dict(self.parse_vars(res.fp))
         except ValueError, e:
             log.error('Bad server response: %s', e, exc_info=True)
-        log.debug('vars:\n%s' % pformat(vars))
+        REQUEST_SECONDS.observe(time.time() - start, request='adjust')
+        log.debug('vars:\n%s', util.LazyString(pformat, vars))
         if vars.get('response') != 'OK':
             if vars['error'] == '1':
                 raise NoContentAvailable
@@ -290,67 +566,297 @@ class RadioClient(object):
             log.error('data: %s')
             raise AdjustError('No data in server response: %s', *e.args)
         self.station_name = vars['stationname']
+        self.tuned_url = url
         log.info('Tuned to %s', self.station_name)
         return res
 
+    def tune(self, url):
+        '''Make sure the session is tuned to `url`. Session saved by
+        previous run is used if there is one, otherwise handshake and/or
+        adjust requests are made as needed.
+        '''
+        if self.session and self.tuned_url == url:
+            return
+        sessions = self.sessions
+        if sessions is not None:
+            saved = sessions.get(self.username, url)
+            if saved is not None:
+                self.session, self.station_name = saved
+                self.tuned_url = url
+                self.log.info('Using saved session tuned to %s',
+                              self.station_name)
+                return
+        if not self.session:
+            self.handshake()
+        self.adjust(url)
+        if sessions is not None:
+            sessions.put(self.username, url, self.session, self.station_name)
+
+    def forget_session(self):
+        '''Drop session rejected by the server so that next tune() starts
+        a new one
+        '''
+        self.log.info('Session rejected. Starting new one.')
+        if self.sessions is not None and self.tuned_url is not None:
+            self.sessions.remove(self.username, self.tuned_url)
+        self.session = self.tuned_url = None
+        self.prefetch = None
+
     def xspf(self, discovery=False):
         '''Fetch and parse XSPF playlist saving result in self.tracks.
            Returns urllib2.Response
         '''
+        res, self.tracks = self.request_xspf(discovery)
+        return res
+
+    def request_xspf(self, discovery=False):
+        '''Fetch and parse XSPF playlist. Returns (urllib2.Response, tracks)
+        '''
         discovery = int(discovery)
         session = self.session
         if not session:
             raise SessionError('No session. Call handshake() first.')
-        res = self.urlopen(self.xspf_url % (session, discovery, VERSION))
-        self.parse_xspf(res.fp)
-        return res
+        start = time.time()
+        try:
+            res = self.urlopen(self.xspf_url % (session, discovery, VERSION))
+        except urllib2.HTTPError, e:
+            if e.code in (401, 403):
+                raise SessionRejected(str(e))
+            raise
+        try:
+            tracks = self.read_xspf(res.fp)
+        except expat.ExpatError, e:
+            # Error message instead of playlist
+            raise SessionRejected('Bad playlist: %s' % e)
+        REQUEST_SECONDS.observe(time.time() - start, request='xspf')
+        return res, tracks
+
+    def fetch_tracks(self, discovery=False):
+        '''Fetch playlist retrying while the server is unavailable.
+        Returns list of tracks
+        '''
+        delay = util.BackoffDelay()
+        while True:
+            # Stopped client, also one prefetching in the background
+            self.cancel.check(once=False)
+            try:
+                res, tracks = self.request_xspf(discovery)
+            except urllib2.HTTPError, e:
+                if e.code == 503:
+                    BACKOFF_SECONDS.inc(delay.sleep(self.sleep))
+            else:
+                return tracks
+
+    def sleep(self, seconds):
+        '''Sleep `seconds`. Raises exception `self.cancel` has been
+        cancelled with for good as soon as that happens. One time
+        cancellation is left for the track being recorded.
+        '''
+        deadline = time.time() + seconds
+        while True:
+            self.cancel.check(once=False)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self.cancel.wait(remaining):
+                # Pending one time cancellation doesn't let wait() block
+                time.sleep(min(remaining, 0.5))
+
+    def next_tracks(self, wait_cb=None):
+        '''Get next playlist into self.tracks using the prefetched one if
+        any. Prefetching of the following playlist is set up to start
+        before the last track of the new batch (see start_prefetch()).
+        '''
+        if self.prefetch is None:
+            self.tracks = self.fetch_tracks()
+        else:
+            self.tracks = self.prefetch.result(wait_cb)
+        self.prefetch = Prefetch(self.fetch_tracks)
+
+    def start_prefetch(self):
+        if self.prefetch is not None:
+            self.prefetch.start()
 
     def parse_vars(self, fp):
         try:
             lines = [ l.strip() for l in fp ] 
         finally:
             fp.close()
-        self.log.debug('data:\n%s', '\n'.join(lines))
+        self.log.debug('data:\n%s', util.LazyString('\n'.join, lines))
         return [ line.strip().split('=', 1) for line in lines ]
 
     def parse_xspf(self, fp):
-        h = XSPFHandler()
+        self.tracks = self.read_xspf(fp)
+
+    def read_xspf(self, fp):
         try:
-            xml.sax.parse(fp, h)
+            parsed = XSPFParser().parse(fp)
         finally:
             fp.close()
-        self.tracks = []
-        for track in h.tracks:
+        tracks = []
+        for track in parsed:
             try:
                 track = Track(track)
             except ValueError, e:
                 self.log.error('%s', e, exc_info=True)
                 continue
-            self.tracks.append(track)
+            tracks.append(track)
 
-        self.log.debug('tracks:\n%s', pformat(self.tracks))
-        self.log.info('Tracks:\n%s',
-            ''.join([ '%s\n' % t.name for t in self.tracks ]))
+        self.log.debug('tracks:\n%s', util.LazyString(pformat, tracks))
+        self.log.info('Tracks:\n%s', util.LazyString(track_names, tracks))
+        return tracks
 
     def handle_tracks(self):
         if not os.path.exists(self.outdir):
             os.makedirs(self.outdir)
-        for track in self.tracks:
-            if self.skip_existing_track(track):
-                self.call(self.track_skip_cb, track)
-                continue
+        tracks = list(self.tracks)
+        if self.jobs > 1 and len(tracks) > 1:
+            self.handle_tracks_parallel(tracks)
+        else:
+            for i, track in enumerate(tracks):
+                if i == len(tracks) - 1:
+                    self.start_prefetch()
+                self.handle_playlist_entry(track)
+        # Not when stopped, that would use up a playlist
+        self.start_prefetch()
+
+    def handle_tracks_parallel(self, tracks):
+        '''Record `tracks` using a pool of ``self.jobs`` worker threads.
+        The first exception escaping a worker (e.g. a loop break raised by a
+        callback) stops the pool and is re-raised in the calling thread.
+
+        KeyboardInterrupt only reaches the calling thread. As with a single
+        job it skips one track being recorded, the one whose worker checks
+        `self.cancel` first. A second one within 0.2 seconds aborts all
+        streams, waits for the workers and is re-raised.
+        '''
+        queue = Queue.Queue()
+        for track in tracks:
+            queue.put(track)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    track = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if queue.empty():
+                    self.start_prefetch()
+                try:
+                    self.handle_playlist_entry(track)
+                except BaseException:
+                    errors.append(sys.exc_info())
+                    return
+
+        workers = []
+        for i in range(min(self.jobs, len(tracks))):
+            t = threading.Thread(name='track-%d' % i, target=worker)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        while True:
             try:
-                self.handle_track(track)
+                for t in workers:
+                    # Join with timeout so that KeyboardInterrupt gets through
+                    while t.isAlive():
+                        t.join(0.5)
+                break
             except KeyboardInterrupt:
-                self.call(self.track_skip_cb, track)
                 self.log.info('Interrupted. Skipping track.')
+                self.cancel.cancel(SkipTrack, once=True)
+            try:
                 time.sleep(0.2)
-            except SkipTrack:
-                self.call(self.track_skip_cb, track)
-            except Exception, e:
-                self.log.exception('handle_tracks: %s', e)
-                self.log.error('Skipping track.')
-                self.call(self.track_skip_cb, track)
+            except KeyboardInterrupt:
+                errors.append(sys.exc_info())
+                # Workers stop after their current tracks, abort those
+                self.cancel.cancel(KeyboardInterrupt)
+                for t in workers:
+                    t.join(SOCKET_TIMEOUT)
+                raise
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+
+    def handle_playlist_entry(self, track):
+        try:
+            # Reading a bit of a skipped stream can be cancelled as well
+            if self.skip_existing_track(track):
+                self.track_skipped(track)
+                return
+            self.handle_track(track)
+        except KeyboardInterrupt:
+            self.track_skipped(track)
+            self.log.info('Interrupted. Skipping track.')
+            time.sleep(0.2)
+        except SkipTrack:
+            self.track_skipped(track)
+        except Exception, e:
+            self.log.exception('handle_tracks: %s', e)
+            self.log.error('Skipping track.')
+            self.track_skipped(track)
+
+    def track_recorded(self, track):
+        TRACKS.inc(result='recorded')
+        self.remember_track(track, 'recorded')
+        self.call(self.track_end_cb, track)
+
+    def track_skipped(self, track):
+        TRACKS.inc(result='skipped')
+        self.remember_track(track, 'skipped')
+        self.call(self.track_skip_cb, track)
+
+    def track_failed(self, track):
+        TRACKS.inc(result='failed')
+        self.remember_track(track, 'failed')
+        self.call(self.track_error_cb, track)
+
+    def remember_track(self, track, result):
+        self.history_lock.acquire()
+        try:
+            self.history.append((track, result))
+        finally:
+            self.history_lock.release()
+
+    def recent_tracks(self):
+        '''Returns list of (track, result) of the last HISTORY_SIZE tracks
+        handled, oldest first. Result is 'recorded', 'skipped' or 'failed'.
+        '''
+        self.history_lock.acquire()
+        try:
+            return list(self.history)
+        finally:
+            self.history_lock.release()
+
+    def recently_recorded(self, track):
+        filename = track.make_filename()
+        for other, result in self.recent_tracks():
+            if result == 'recorded' and other.make_filename() == filename:
+                return True
+        return False
+
+    def observe_stream(self, res, started, first_byte, count):
+        '''Record time to first byte and throughput of stream `res`
+        requested at `started` which received first data at `first_byte`
+        '''
+        host = urlparse.urlsplit(res.geturl())[1]
+        STREAM_BYTES.inc(count, host=host)
+        if first_byte is None:
+            return
+        FIRST_BYTE_SECONDS.observe(first_byte - started, host=host)
+        elapsed = time.time() - started
+        if elapsed > 0:
+            STREAM_BYTES_PER_SECOND.observe(count / elapsed, host=host)
+
+    def stream_aborted(self, track, res, reason, msg):
+        '''Report that `track` stream `res` has been given up on
+        '''
+        self.log.error('%s: %s', msg, track.name)
+        host = urlparse.urlsplit(res.geturl())[1]
+        STREAM_ABORTS.inc(host=host, reason=reason)
+
+    def make_watchdog(self):
+        return ThroughputWatchdog(self.min_rate, self.stall_window)
 
     def call(self, callback, *args, **kw):
         try:
@@ -363,44 +869,196 @@ class RadioClient(object):
         log = self.log
         self.call(self.track_start_cb, track)
         # Handle audio/mpeg stream
-        prefix = '.%s.' % track.make_filename()
-        fd, tmp = tempfile.mkstemp(dir=self.outdir, prefix=prefix)
-        log.debug('tmp: %s', tmp)
-        self.temp_files.add(tmp)
-        fp = os.fdopen(fd, 'w+b')
+        fp, tmp, start = self.open_temp_file(track)
+        writer = FileWriter(fp)
         exceptions = (IOError, OSError, socket.error, httplib.HTTPException)
         log.info(track.name)
+        complete = kept = abandoned = False
         try:
-            self.handle_stream(track, fp)
-        except urllib2.HTTPError, e:
-            log.exception(e)
-            log.info('Skipping %s', track.name)
-            raise SkipTrack
-        except exceptions, e:
-            log.exception(e)
-        else:
-            self.finish_track(track, fp, tmp)
-            self.call(self.track_end_cb, track)
-        finally:
-            if os.path.exists(tmp):
-                log.debug('Removing %s', tmp)
+            for attempt in range(RESUME_ATTEMPTS + 1):
+                if attempt:
+                    if self.cancel.wait(RESUME_DELAY):
+                        self.cancel.check()
                 try:
-                    os.unlink(tmp)
-                except (IOError, OSError):
-                    pass
-                else:
-                    self.temp_files.remove(tmp)
+                    # Disk errors are not retried like read errors
+                    writer.flush()
+                except exceptions, e:
+                    log.exception(e)
+                    break
+                fp.seek(0, os.SEEK_END)
+                offset = fp.tell() - start
+                if attempt:
+                    log.info('Resuming %s at %d bytes', track.name, offset)
+                try:
+                    complete = self.handle_stream(track, writer, offset)
+                except urllib2.HTTPError, e:
+                    log.exception(e)
+                    if not offset:
+                        log.info('Skipping %s', track.name)
+                        raise SkipTrack
+                    break
+                except exceptions, e:
+                    log.exception(e)
+                if complete:
+                    break
+            abandoned = not writer.close()
+            if abandoned:
+                # The writer thread closes fp once the stalled write returns
+                kept = True
+                self.keep_temp_file(tmp)
+                self.track_failed(track)
+            elif complete:
+                fp.close()
+                # The post-processor takes care of the file now
+                kept = True
+                self.queue_finish(track, tmp)
+                self.track_recorded(track)
+            else:
+                # Keep what has been recorded for a later run
+                fp.seek(0, os.SEEK_END)
+                try:
+                    # Release space preallocated for the rest of the stream
+                    fp.truncate()
+                except (IOError, OSError), e:
+                    log.error('Cannot truncate %s: %s', fp.name, e)
+                kept = fp.tell() > start
+                if kept:
+                    self.keep_temp_file(tmp)
+                self.track_failed(track)
+        finally:
+            if not writer.closed:
+                abandoned = not writer.close()
+            if not abandoned:
+                fp.close()
+            if not kept:
+                self.remove_temp_file(tmp)
+
+    def create_temp_file(self, track):
+        '''Create hidden temporary file for `track` in output directory.
+        Returns (file object, path)
+        '''
+        prefix = '.%s.' % track.make_filename()
+        fd, tmp = tempfile.mkstemp(dir=self.outdir, prefix=prefix)
+        self.log.debug('tmp: %s', tmp)
+        self.add_temp_file(tmp)
+        self.write_tags(track, tmp)
+        fp = os.fdopen(fd, 'w+b', self.write_buffer)
+        fp.seek(0, os.SEEK_END)
+        return fp, tmp
+
+    def open_temp_file(self, track):
+        '''Open partial recording of `track` left by previous run or create
+        new temporary file. Returns (file object positioned at the end,
+        path, offset of audio data in file)
+        '''
+        path = self.take_partial_file(track)
+        if path is not None:
+            self.add_temp_file(path)
+            try:
+                fp = open(path, 'r+b', self.write_buffer)
+                start = 0
+                if mutagen.available():
+                    start = id3_size(fp)
+            except (IOError, OSError), e:
+                self.log.error('Cannot open %s: %s', path, e)
+                self.remove_temp_file(path)
+            else:
+                fp.seek(0, os.SEEK_END)
+                self.log.info('Resuming partial recording %s', path)
+                return fp, path, start
+        fp, tmp = self.create_temp_file(track)
+        return fp, tmp, fp.tell()
+
+    def keep_temp_file(self, tmp):
+        '''Leave partial recording `tmp` for a later resume
+        '''
+        self.log.info('Keeping partial recording %s', tmp)
+        self.discard_temp_file(tmp)
+
+    def recover_temp_files(self):
+        '''Find partial recordings left in output directory by previous
+        runs. They are resumed when their tracks are played again.
+        '''
+        partial_files = {}
+        try:
+            names = os.listdir(self.outdir)
+        except OSError, e:
+            self.log.error('Cannot list %s: %s', self.outdir, e)
+            names = []
+        self.temp_files_lock.acquire()
+        try:
+            for name in names:
+                # .<artist>_-_<title>.mp3.<random> made by create_temp_file()
+                if not name.startswith('.') or '.mp3.' not in name:
+                    continue
+                path = os.path.join(self.outdir, name)
+                if path in self.temp_files:
+                    continue
+                filename = name[1:name.rindex('.mp3.') + 4]
+                other = partial_files.get(filename)
+                if other is not None:
+                    if os.path.getsize(other) >= os.path.getsize(path):
+                        continue
+                partial_files[filename] = path
+            self.partial_files = partial_files
+        finally:
+            self.temp_files_lock.release()
+        if partial_files:
+            self.log.info('Found %d partial recordings in %s',
+                          len(partial_files), self.outdir)
+
+    def take_partial_file(self, track):
+        self.temp_files_lock.acquire()
+        try:
+            return self.partial_files.pop(track.make_filename(), None)
+        finally:
+            self.temp_files_lock.release()
+
+    def remove_temp_file(self, tmp):
+        if os.path.exists(tmp):
+            self.log.debug('Removing %s', tmp)
+            try:
+                os.unlink(tmp)
+            except (IOError, OSError):
+                return
+        self.discard_temp_file(tmp)
 
     def skip_existing_track(self, track):
         if not self.skip_existing:
             return
-        existing = track.find_existing(self.outdir)
+        existing = self.find_existing(track)
         if not existing:
             return
         self.log.info('Skipping existing: %s', existing)
+        partial = self.take_partial_file(track)
+        if partial is not None:
+            self.log.info('Removing partial recording %s', partial)
+            self.remove_temp_file(partial)
         self.skip_track(track)
         return existing
 
+    def find_existing(self, track):
+        '''Look `track` up in the catalog or, if there is none, check all
+        possible paths in output directory
+        '''
+        if self.postprocessor.is_pending(track.make_filename()):
+            return 'recording being saved'
+        if self.recently_recorded(track):
+            return 'recorded recently'
+        if self.catalog is not None:
+            try:
+                self.catalog.import_outdir(self.outdir)
+                path = self.catalog.find(self.outdir, track,
+                                         self.path_template)
+                if path is not None and not os.path.exists(path):
+                    # Deleted since, record it again
+                    self.catalog.remove(path)
+                    path = None
+                return path
+            except DatabaseError, e:
+                self.log.error('Catalog lookup failed: %s', e, exc_info=True)
+        return track.find_existing(self.outdir, self.path_template)
+
     def skip_track(self, track):
         '''Try to read a small portion of stream and proceed to next
         track
@@ -411,45 +1069,97 @@ class RadioClient(object):
             self.log.error('%s', e, exc_info=True)
             return
         data = None
-        while data is None:
-            try:
-                r = self._socket_select(res)
-            except (IOError, OSError), e:
-                self.log.exception('skip_track: select: %s', e)
-                continue
-            try:
-                data = res.fp.read(SOCKET_READ_SIZE)
-            except (socket.error, IOError, OSError), e:
-                self.log.exception('skip_track: read: %s', e)
-
-    def finish_track(self, track, fp, tmp):
-        self.log.debug('\n')
-        self.add_tags(track, tmp)
-        fullpath = self.make_track_dirs(track)
-        fp.close()
-        # shutil.move() may not work reliably with FS that doesn't support
-        # mode/ownership attributes (e.g. FAT)
-        try:
-            shutil.copyfile(tmp, fullpath)
-        except (OSError, IOError), e:
-            self.log.error('Cannot copy %s to %s', tmp, fullpath, exc_info=True)
+        try:
+            while data is None:
+                try:
+                    r = self._socket_select(res)
+                except (IOError, OSError), e:
+                    self.log.exception('skip_track: select: %s', e)
+                    continue
+                try:
+                    data = res.fp.read(SOCKET_READ_SIZE)
+                except (socket.error, IOError, OSError), e:
+                    self.log.exception('skip_track: read: %s', e)
+        finally:
+            res.close()
+
+    def queue_finish(self, track, tmp):
+        '''Have complete recording `tmp` finished in the background. It is
+        no longer removed at exit: if the process ends first the recording
+        is found as a partial one by the next run.
+        '''
+        self.discard_temp_file(tmp)
+        self.postprocessor.submit(track.make_filename(), self.finish_track,
+                                  track, tmp)
+
+    def finish_track(self, track, tmp):
+        '''Tag recording `tmp` and move it into place. Runs in a
+        post-processing thread.
+        '''
+        try:
+            self.add_tags(track, tmp)
+            fullpath = self.make_track_dirs(track)
+            method = util.move_file(tmp, fullpath)
+        except Exception, e:
+            self.log.error('Cannot save %s: %s', tmp, e, exc_info=True)
+            # Complete recording, don't lose it
+            self.keep_temp_file(tmp)
             return
-        os.unlink(tmp)
+        self.log.debug('Moved %s to %s (%s)', tmp, fullpath, method)
+        if self.catalog is not None:
+            try:
+                self.catalog.add(self.outdir, fullpath)
+            except DatabaseError, e:
+                self.log.error('Cannot add %s to catalog: %s', fullpath, e)
+        for hook in self.finish_hooks:
+            self.call(hook, track, fullpath)
         self.log.info('Saved to %s', fullpath)
 
+    def set_tags(self, track, tags):
+        from mutagen import id3
+        tags.add(id3.TIT2(encoding=3, text=track['title']))
+        tags.add(id3.TALB(encoding=3, text=track['album']))
+        tags.add(id3.TPE1(encoding=3, text=track['creator']))
+
+    def has_tags(self, track, tags):
+        for frame, key in [('TIT2', 'title'), ('TALB', 'album'),
+                           ('TPE1', 'creator')]:
+            if frame not in tags or list(tags[frame].text) != [track[key]]:
+                return False
+        return True
+
+    def write_tags(self, track, path):
+        '''Write padded ID3 header with title, album, artist tags to empty
+        file `path` if mutagen available. Audio data is then appended after
+        the header and add_tags() finds the tags in place.
+        '''
+        if not mutagen.available():
+            return
+        from mutagen import id3
+        tags = id3.ID3()
+        self.set_tags(track, tags)
+        try:
+            if mutagen.version >= (1, 30):
+                tags.save(path, padding=lambda info: ID3_PADDING)
+            else:
+                tags.save(path)
+        except (mutagen.id3.error, IOError, OSError), e:
+            self.log.error('Failed to write tags: %s', e, exc_info=True)
+
     def add_tags(self, track, path):
         '''Add ID3 title, album, artist tags to the file if mutagen available
+        and they haven't been written by write_tags()
         '''
-        if mutagen is None:
+        if not mutagen.available():
             return
         log = self.log
-        from mutagen import id3, mp3
+        from mutagen import mp3
         f = mp3.MP3(path)
         if f.tags is None:
             f.add_tags()
-        f.tags.add(id3.TIT2(encoding=3, text=track['title']))
-        f.tags.add(id3.TALB(encoding=3, text=track['album']))
-        f.tags.add(id3.TPE1(encoding=3, text=track['creator']))
+        elif self.has_tags(track, f.tags):
+            return
+        self.set_tags(track, f.tags)
         try:
             f.save()
         except mutagen.id3.error, e:
@@ -459,11 +1169,15 @@ class RadioClient(object):
         # Make all dirs in path
         outdir = self.outdir
         trackpath = track.getpath(self.strip_windows_incompat,
-                                  self.strip_spaces)
+                                  self.strip_spaces, self.path_template)
         trackdir = os.path.join(outdir, os.path.dirname(trackpath))
         self.log.debug('Track dir: %s', trackdir)
-        if not os.path.exists(trackdir):
+        try:
             os.makedirs(trackdir)
+        except OSError, e:
+            # Made by another post-processing thread or earlier
+            if e.errno != errno.EEXIST:
+                raise
         fullpath = os.path.join(outdir, trackpath)
         return fullpath
 
@@ -473,91 +1187,231 @@ class RadioClient(object):
                    for h in headers if h.startswith('Content-Length') ][0]
         return length
 
-    def handle_stream(self, track, fp):
-        '''Write `track` audio stream to `fp`
+    def request_stream(self, track, offset=0):
+        '''Request `track` audio stream starting at byte `offset`. Offset is
+        0 if the server can't resume the stream. Returns (urllib2.Response,
+        offset, stream length)
+        '''
+        log = self.log
+        request = urllib2.Request(track['location'])
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            res = self.urlopen(request)
+        except urllib2.HTTPError, e:
+            if not offset or e.code != 416:
+                raise
+            log.warn('Cannot resume %s: %s', track.name, e)
+            return self.request_stream(track)
+        try:
+            if offset and res.code != 206:
+                log.warn('Server does not resume %s. Starting over.',
+                         track.name)
+                offset = 0
+            if not offset:
+                return res, 0, self.get_content_length(res)
+            start, length = get_content_range(res)
+            if start != offset:
+                raise ResumeError('Range requested from %d got %d' %
+                                  (offset, start))
+            return res, offset, length
+        except (IndexError, ValueError, ResumeError):
+            res.close()
+            raise
+
+    def handle_stream(self, track, writer, offset=0):
+        '''Write `track` audio stream with `writer` to its file which ends
+        with first `offset` bytes of the stream. Returns ``True`` if the
+        stream is complete and written
         '''
         log = self.log
-        res = self.urlopen(track['location'])
+        fp = writer.fp
+        started = time.time()
         try:
-            length = self.get_content_length(res)
-        except ValueError:
+            res, count, length = self.request_stream(track, offset)
+        except (IndexError, ValueError):
             log.error('Failed to get Content-Length')
-            return
+            return False
+        if count < offset:
+            fp.seek(count - offset, os.SEEK_END)
+            fp.truncate()
+        util.preallocate(fp, length - count)
 
-        count = 0
-        while True:
-            try:
-                r = self._socket_select(res)
-            except (IOError, OSError), e:
-                log.exception('handle_stream: select: %s', e)
-                continue
-            if not r:
-                log.error('Read timeout reached')
-                break
-            try:
-                data = res.fp.read(SOCKET_READ_SIZE)
-                count += len(data)
-                fp.write(data)
-            except (socket.error, IOError, OSError), e:
-                log.exception('handle_stream: read: %s', e)
-            else:
+        sock, data = detach_socket(res)
+        offset = count
+        count += len(data)
+        first_byte = None
+        watchdog = self.make_watchdog()
+        watchdog.start()
+        try:
+            if data:
+                first_byte = time.time()
+                writer.write(data)
                 self.call(self.progress_cb, track, count, length)
-            if count >= length:
-                fp.flush()
-                break
+            buf = ReadBuffer()
+            while count < length:
+                try:
+                    r = self._socket_select(res)
+                except (IOError, OSError), e:
+                    log.exception('handle_stream: select: %s', e)
+                    continue
+                if not r:
+                    self.stream_aborted(track, res, 'timeout',
+                                        'Read timeout reached')
+                    break
+                try:
+                    data = buf.recv(sock)
+                    if not data:
+                        self.stream_aborted(track, res, 'closed',
+                                            'Connection closed')
+                        break
+                    if first_byte is None:
+                        first_byte = time.time()
+                    count += len(data)
+                except (socket.error, IOError, OSError), e:
+                    log.exception('handle_stream: read: %s', e)
+                else:
+                    # Disk errors are not retried like read errors
+                    writer.write(data)
+                    self.call(self.progress_cb, track, count, length)
+                    watchdog.update(len(data))
+                    slow = watchdog.check()
+                    if slow and count < length:
+                        self.stream_aborted(track, res, 'slow',
+                                            'Stream too slow (%s)' % slow)
+                        break
+            writer.flush()
+        finally:
+            self.observe_stream(res, started, first_byte, count - offset)
+            if count == length:
+                connpool.release(res)
+            else:
+                res.close()
+        return count >= length
 
     def _socket_select(self, res):
-        for i in range(int(SOCKET_TIMEOUT * 10)):
-            # XXX A workaround for issue #1327971
-            # http://bugs.python.org/issue1327971
-            fileno = res.fp._sock.fp.fileno()
-            r, w, x = select.select([fileno], [], [fileno], 0.1)
-            if r:
-                break
-            self.call(self.read_cb)
-        return r
+        '''Wait up to SOCKET_TIMEOUT seconds for data on `res`. Raises
+        exception `self.cancel` has been cancelled with as soon as that
+        happens. Returns empty list on timeout.
+        '''
+        sock = get_socket(res)
+        deadline = time.time() + SOCKET_TIMEOUT
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return []
+            r, w, x = select.select([sock, self.cancel], [], [sock], timeout)
+            if self.cancel in r:
+                self.cancel.check()
+                # One time cancellation has been taken by another thread
+                r.remove(self.cancel)
+            if r or x:
+                return r or x
 
     def loop(self, urls):
         log = self.log
-        self.handshake()
         log.info('Output directory is %s', self.outdir)
-        for url in urls:
-            while True:
-                try:
-                    self.adjust(url)
-                except InvalidURL, e:
-                    log.error('%s', e)
-                    break
-                except NoContentAvailable:
-                    log.info('No content available for "%s"', url)
-                    break
-                except AdjustError, e:
-                    log.error('Failed to tune to "%s": %s', url, e)
-                    break
-                except (httplib.HTTPException, urllib2.URLError, IOError,
-                        socket.error), e:
-                    log.error('Failed to tune to "%s": %s', url, e,
-                              exc_info=True)
-                    break
-
-                delay = util.BackoffDelay()
+        self.recover_temp_files()
+        try:
+            for url in urls:
+                rejected = False
                 while True:
                     try:
-                        self.xspf()
-                    except urllib2.HTTPError, e:
-                        if e.code == 503:
-                            delay.sleep()
-                    else:
+                        self.tune(url)
+                    except InvalidURL, e:
+                        log.error('%s', e)
+                        break
+                    except NoContentAvailable:
+                        log.info('No content available for "%s"', url)
+                        break
+                    except AdjustError, e:
+                        log.error('Failed to tune to "%s": %s', url, e)
+                        break
+                    except (httplib.HTTPException, urllib2.URLError, IOError,
+                            socket.error), e:
+                        log.error('Failed to tune to "%s": %s', url, e,
+                                  exc_info=True)
                         break
-                self.handle_tracks()
-                # Pause for a while to let user some time to interrupt loop
+
+                    try:
+                        self.next_tracks()
+                    except SessionRejected, e:
+                        if rejected:
+                            # Even a new session does not work
+                            log.error('Failed to get playlist: %s', e)
+                            break
+                        rejected = True
+                        self.forget_session()
+                        continue
+                    rejected = False
+                    self.handle_tracks()
+                    # Pause for a while to let user some time to interrupt loop
+                    time.sleep(0.5)
+                self.prefetch = None
                 time.sleep(0.5)
-            time.sleep(0.5)
+        finally:
+            # Let queued recordings be saved before exiting
+            self.postprocessor.join()
+
+
+def get_socket(res):
+    '''Get socket object underlying urllib2 response `res`
+    '''
+    # XXX A workaround for issue #1327971
+    # http://bugs.python.org/issue1327971
+    return res.fp._sock.fp._sock
+
+
+def get_content_range(res):
+    '''Parse Content-Range header of partial response `res`. Returns
+    (first byte position, complete length)
+    '''
+    value = res.headers.get('Content-Range', '')
+    unit, sep, spec = value.strip().partition(' ')
+    byte_range, sep, length = spec.partition('/')
+    if unit != 'bytes' or not sep:
+        raise ValueError('Bad Content-Range: %r' % value)
+    return int(byte_range.split('-')[0]), int(length)
+
+
+def id3_size(fp):
+    '''Size of ID3v2 tag at the beginning of file `fp` or 0
+    '''
+    fp.seek(0)
+    header = fp.read(10)
+    if len(header) < 10 or not header.startswith('ID3'):
+        return 0
+    size = 0
+    for c in header[6:10]:
+        size = size << 7 | ord(c) & 0x7f
+    # Footer present flag
+    if ord(header[5]) & 0x10:
+        size += 10
+    return size + 10
+
+
+def detach_socket(res):
+    '''Get socket underlying urllib2 response `res` along with the body
+    data httplib has already buffered while reading headers. Reading the
+    socket directly returns whatever data is available instead of blocking
+    until the requested amount arrives. `res` must not be read afterwards.
+    Returns (socket, data)
+    '''
+    # Buffered file object of a response made with
+    # getresponse(buffering=True), see connpool.KeepAliveHandler.request.
+    # Unbuffered one has an empty read buffer.
+    fp = res.fp._sock.fp
+    data = fp._rbuf.getvalue()
+    fp._rbuf.seek(0)
+    fp._rbuf.truncate()
+    return fp._sock, data
 
 
-def setup_urllib2():
-    '''Set cookie processor and default HTTP headers.
+def setup_urllib2(pool=None):
+    '''Set cookie processor, persistent connections and default HTTP
+    headers.
     '''
-    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
+    opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(),
+                                  connpool.KeepAliveHandler(pool))
     opener.addheaders = [('User-Agent', USER_AGENT)]
     urllib2.install_opener(opener)
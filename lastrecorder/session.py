@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Radio sessions saved between runs.
+
+A session tuned to a station is saved per user and station URL so that
+the next run can request playlists right away without handshake and
+adjust requests. Every station gets its own session because tuning one
+session to another station would retune all clients using it.
+'''
+
+from __future__ import with_statement
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from ConfigParser import RawConfigParser, Error as ConfigError
+
+# Seconds a saved session is used for
+SESSION_MAX_AGE = 6 * 3600
+
+
+class SessionCache(object):
+    def __init__(self, path, max_age=SESSION_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.parser = RawConfigParser()
+        try:
+            self.parser.read(path)
+        except ConfigError, e:
+            self.log.error('Cannot read %s: %s', path, e)
+
+    def section(self, username, url):
+        return '%s %s' % (username, url)
+
+    def get(self, username, url):
+        '''Get session tuned to `url` for `username`. Returns (session,
+        station name) or ``None`` if there is no such session or it has
+        expired
+        '''
+        section = self.section(username, url)
+        with self.lock:
+            try:
+                updated = self.parser.getfloat(section, 'updated')
+                if time.time() - updated > self.max_age:
+                    return
+                return (self.parser.get(section, 'session'),
+                        self.parser.get(section, 'station_name'))
+            except (ConfigError, ValueError):
+                return
+
+    def put(self, username, url, session, station_name):
+        section = self.section(username, url)
+        with self.lock:
+            if not self.parser.has_section(section):
+                self.parser.add_section(section)
+            self.parser.set(section, 'session', session)
+            self.parser.set(section, 'station_name', station_name or '')
+            self.parser.set(section, 'updated', repr(time.time()))
+            self.write()
+
+    def remove(self, username, url):
+        with self.lock:
+            if self.parser.remove_section(self.section(username, url)):
+                self.write()
+
+    def write(self):
+        # Session keys are as good as passwords: keep the file private and
+        # never leave it half written
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.sessions.')
+            with os.fdopen(fd, 'w') as fp:
+                self.parser.write(fp)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            self.log.error('Cannot write %s: %s', self.path, e)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Recording several stations at once.
+
+Every station gets its own ``RadioClient`` session running in a separate
+thread. The clients share the urllib2 opener (and so the connection pool),
+the output directory and the catalog.
+'''
+
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from lastrecorder.exceptions import StopRecording
+from lastrecorder.radio import HandshakeError
+
+
+class Station(object):
+    '''Station recorded by ``MultiRecorder`` with its own status and
+    counters
+    '''
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.status = 'Idle'
+        self.started = 0
+        self.recorded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(self.__class__.__name__)
+        client.track_start_cb = self.track_start_cb
+        client.track_end_cb = self.track_end_cb
+        client.track_skip_cb = self.track_skip_cb
+        client.track_error_cb = self.track_error_cb
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+
+    def track_start_cb(self, track):
+        self.count('started')
+        self.status = 'Recording %s' % track.name
+
+    def track_end_cb(self, track):
+        self.count('recorded')
+        self.status = 'Recorded %s' % track.name
+
+    def track_skip_cb(self, track):
+        self.count('skipped')
+        self.status = 'Skipped %s' % track.name
+
+    def track_error_cb(self, track):
+        self.count('failed')
+        self.status = 'Failed to record %s' % track.name
+
+    def start(self):
+        self.thread = threading.Thread(name='station %s' % self.url,
+                                       target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        self.status = 'Logging in'
+        try:
+            self.client.loop([self.url])
+        except StopRecording:
+            self.status = 'Stopped'
+        except HandshakeError, e:
+            self.status = 'Login failed: %s' % e
+        except (IOError, socket.error, httplib.HTTPException), e:
+            self.log.exception('I/O or HTTP error: %s', e)
+            self.status = 'I/O or HTTP error: %s' % e
+        except Exception, e:
+            self.log.exception('Unexpected error: %s', e)
+            self.status = 'Unexpected error: %s' % e
+        else:
+            self.status = 'Finished'
+
+    def stop(self):
+        '''Make the client stop recording. Recorded tracks are still saved
+        before `join` returns.
+        '''
+        self.status = 'Stopping'
+        self.client.cancel.cancel(StopRecording)
+
+    def join(self):
+        while self.is_alive():
+            # Join with timeout so that KeyboardInterrupt gets through
+            self.thread.join(0.5)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.isAlive()
+
+    def __str__(self):
+        return ('%s [%s] recorded: %d, skipped: %d, failed: %d' %
+                (self.url, self.status, self.recorded, self.skipped,
+                 self.failed))
+
+
+class MultiRecorder(object):
+    # Seconds between status reports
+    report_interval = 60
+
+    def __init__(self, stations):
+        self.stations = stations
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def run(self):
+        '''Record all stations until they finish or KeyboardInterrupt
+        stops them
+        '''
+        for station in self.stations:
+            station.start()
+        last_report = time.time()
+        try:
+            while [ s for s in self.stations if s.is_alive() ]:
+                time.sleep(0.5)
+                if time.time() - last_report >= self.report_interval:
+                    self.report()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            self.log.info('Interrupted. Stopping stations.')
+            self.stop()
+        self.report()
+
+    def stop(self):
+        for station in self.stations:
+            station.stop()
+        # Each client's loop() saves its recorded tracks before returning
+        for station in self.stations:
+            station.join()
+
+    def report(self):
+        for station in self.stations:
+            self.log.info('%s', station)
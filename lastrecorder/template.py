@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Track file name templates.
+
+A template such as ``{artist:.1}/{artist}/{album}/{title}.mp3`` names
+track fields in ``str.format`` syntax, optionally with a format spec, and
+separates directories with slashes. ``PathTemplate`` compiles it once into
+a format string; rendering a track then takes one ``translate`` call per
+field to replace characters that can't appear in file names and one
+``format`` call.
+'''
+
+import operator
+import os
+import string
+
+DEFAULT_TEMPLATE = '{artist}/{album}/{title}.mp3'
+# Name of temporary and partial recordings, see RadioClient.create_temp_file
+FILENAME_TEMPLATE = '{artist}_-_{title}.mp3'
+FIELDS = {'artist': 'creator', 'creator': 'creator', 'album': 'album',
+          'title': 'title'}
+WINDOWS_INCOMPAT = '\\/:*?;"<>|'
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def replace_chars(value, chars, substitute):
+    '''Replace every character of `chars` in `value` with `substitute`
+    '''
+    if isinstance(value, unicode):
+        return value.translate(dict([ (ord(c), unicode(substitute))
+                                      for c in chars ]))
+    if len(substitute) != 1:
+        return ''.join([ c in chars and substitute or c for c in value ])
+    return value.translate(string.maketrans(chars, substitute * len(chars)))
+
+
+def make_tables(strip_windows_incompat, strip_spaces):
+    '''Returns translate tables for byte and unicode strings replacing
+    characters as Track.getpath always did: Windows-incompatible ones and
+    spaces with underscores if asked to and path separators with dashes
+    '''
+    mapping = {os.path.sep: '-'}
+    if strip_spaces:
+        mapping[' '] = '_'
+    if strip_windows_incompat:
+        for c in WINDOWS_INCOMPAT:
+            mapping[c] = '_'
+    chars = mapping.keys()
+    table = string.maketrans(''.join(chars),
+                             ''.join([ mapping[c] for c in chars ]))
+    utable = dict([ (ord(c), unicode(mapping[c])) for c in chars ])
+    return table, utable
+
+TABLES = dict([ ((w, s), make_tables(w, s))
+                for w in (False, True) for s in (False, True) ])
+
+
+def make_getter(keys):
+    '''Returns function getting tuple of `keys` attributes of a track
+    '''
+    if not keys:
+        return lambda track: ()
+    if len(keys) == 1:
+        getter = operator.attrgetter(keys[0])
+        return lambda track: (getter(track),)
+    return operator.attrgetter(*keys)
+
+
+class PathTemplate(object):
+    def __init__(self, template=DEFAULT_TEMPLATE):
+        self.template = template
+        if os.path.isabs(template):
+            raise TemplateError('Path template must be relative: %s' %
+                                template)
+        fmt = []
+        # Track keys in order of positional format fields
+        self.keys = []
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError, e:
+            raise TemplateError('Bad path template %s: %s' % (template, e))
+        for literal, field, spec, conversion in parsed:
+            literal = literal.replace('{', '{{').replace('}', '}}')
+            fmt.append(literal.replace('/', os.path.sep))
+            if field is None:
+                continue
+            if field not in FIELDS or conversion:
+                if conversion:
+                    field += '!' + conversion
+                raise TemplateError('Bad field {%s} in path template %s. '
+                                    'Known fields: %s' %
+                                    (field, template,
+                                     ', '.join(sorted(FIELDS))))
+            fmt.append('{%d%s}' % (len(self.keys), spec and ':' + spec))
+            self.keys.append(FIELDS[field])
+        self.format = ''.join(fmt)
+        self.get_values = make_getter(self.keys)
+        self.uformat = unicode(self.format)
+        try:
+            self.format.format(*['x'] * len(self.keys))
+        except (ValueError, KeyError, IndexError), e:
+            raise TemplateError('Bad path template %s: %s' % (template, e))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.template)
+
+    def render(self, track, strip_windows_incompat=False,
+               strip_spaces=False):
+        '''Relative path of `track` file
+        '''
+        table, utable = TABLES[bool(strip_windows_incompat),
+                               bool(strip_spaces)]
+        values = []
+        fmt = self.format
+        for value in self.get_values(track):
+            if isinstance(value, unicode):
+                values.append(value.translate(utable))
+                fmt = self.uformat
+            else:
+                values.append(value.translate(table))
+        return fmt.format(*values)
+
+
+default_template = PathTemplate()
+filename_template = PathTemplate(FILENAME_TEMPLATE)
@@ -12,7 +12,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import with_statement
+import errno
+import imp
 import logging
+import os
+import shutil
+import sys
+import threading
 import time
 import urllib2
 try:
@@ -25,21 +32,254 @@ class BackoffDelay(object):
         self.mult = mult
         self.count = 0
 
-    def sleep(self):
+    def sleep(self, wait=time.sleep):
+        '''Wait next delay with `wait` function. Returns the delay
+        '''
         seconds = self.mult * self.count * self.count
         log = logging.getLogger('BackoffDelay')
         log.info('Sleeping %s seconds', seconds)
-        time.sleep(seconds)
+        wait(seconds)
         self.count += 1
+        return seconds
 
     def reset(self):
         self.count = 0
 
 
+class LazyModule(object):
+    '''Stand-in for top level module `name` which is imported on first
+    attribute access. Checking if the module is `available` doesn't import
+    it.
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def available(self):
+        if self._module is not None or self._name in sys.modules:
+            return True
+        try:
+            fp, pathname, description = imp.find_module(self._name)
+        except ImportError:
+            return False
+        if fp is not None:
+            fp.close()
+        return True
+
+
+class LazyString(object):
+    '''Log message argument calling `func` with `args` only when the
+    message is formatted, i.e. when its level is enabled:
+
+        log.debug('vars:\\n%s', LazyString(pformat, vars))
+    '''
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        # Unicode result is fine, '%s' formatting keeps it unicode
+        value = self.func(*self.args)
+        if not isinstance(value, basestring):
+            value = str(value)
+        return value
+
+
+class LatestValue(object):
+    '''Slot holding only the most recent value put by a producer thread.
+    A consumer polling it with `take` gets every value at most once and
+    never sees intermediate updates it was too slow for.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.changed = False
+
+    def put(self, value):
+        with self.lock:
+            self.value = value
+            self.changed = True
+
+    def take(self):
+        '''Return value put since previous call or ``None``
+        '''
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            return self.value
+
+    def clear(self):
+        with self.lock:
+            self.value = None
+            self.changed = False
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Permissions of newly created files
+FILE_MODE = 0666 & ~get_umask()
+
+
+def same_device(src, dst):
+    '''Check if file `src` can be renamed to `dst`
+    '''
+    try:
+        dstdir = os.path.dirname(os.path.abspath(dst))
+        return os.stat(src).st_dev == os.stat(dstdir).st_dev
+    except OSError:
+        return False
+
+
+_libc = []
+
+
+def get_libc():
+    '''Returns C library loaded with ctypes or ``None``
+    '''
+    if not _libc:
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except (ImportError, OSError):
+            libc = None
+        _libc.append(libc)
+    return _libc[0]
+
+
+# fallocate(2) flag to allocate space without changing file size
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = []
+
+
+def get_fallocate():
+    '''Returns libc fallocate function or ``None``
+    '''
+    if not _fallocate:
+        func = None
+        libc = get_libc()
+        if libc is not None:
+            import ctypes
+            func = (getattr(libc, 'fallocate64', None) or
+                    getattr(libc, 'fallocate', None))
+            if func is not None:
+                func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64]
+        _fallocate.append(func)
+    return _fallocate[0]
+
+
+# Most bytes Linux sendfile(2) transfers at once
+SENDFILE_MAX = 0x7ffff000
+_sendfile = []
+
+
+def get_sendfile():
+    '''Returns libc sendfile function or ``None``
+    '''
+    if not _sendfile:
+        func = None
+        libc = get_libc()
+        if libc is not None:
+            import ctypes
+            func = (getattr(libc, 'sendfile64', None) or
+                    getattr(libc, 'sendfile', None))
+            if func is not None:
+                func.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t]
+                func.restype = ctypes.c_long
+        _sendfile.append(func)
+    return _sendfile[0]
+
+
+def sendfile_copy(src, dst):
+    '''Copy `src` to `dst` in kernel space with sendfile(2). Raises
+    ``OSError`` with ``ENOSYS`` if libc has no sendfile, or the error of a
+    failed call (e.g. ``EINVAL`` on kernels that can't send to files).
+    '''
+    sendfile = get_sendfile()
+    if sendfile is None:
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    import ctypes
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            # Advanced by the kernel
+            offset = ctypes.c_int64(0)
+            while offset.value < size:
+                sent = sendfile(fdst.fileno(), fsrc.fileno(),
+                                ctypes.byref(offset),
+                                min(size - offset.value, SENDFILE_MAX))
+                if sent < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e))
+                if not sent:
+                    break
+
+
+def move_file(src, dst):
+    '''Move `src` to `dst` replacing existing file. Renames if both are on
+    the same device, otherwise copies the data without copying file mode
+    and ownership. Returns name of the method used
+    '''
+    if same_device(src, dst):
+        if os.name == 'nt' and os.path.exists(dst):
+            os.unlink(dst)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            pass
+        else:
+            # mkstemp() creates files readable by owner only
+            try:
+                os.chmod(dst, FILE_MODE)
+            except OSError:
+                pass
+            return 'rename'
+    try:
+        sendfile_copy(src, dst)
+        method = 'sendfile'
+    except (OSError, IOError):
+        # shutil.move() may not work reliably with FS that doesn't support
+        # mode/ownership attributes (e.g. FAT)
+        shutil.copyfile(src, dst)
+        method = 'copy'
+    os.unlink(src)
+    return method
+
+
+def preallocate(fp, length):
+    '''Reserve disk space for `length` bytes after current position of file
+    `fp`. Unlike posix_fallocate() file size doesn't change, so a file left
+    by a crash still ends where its data does. Space not written to is
+    released by truncating the file. Returns ``True`` if space has been
+    reserved.
+    '''
+    fallocate = get_fallocate()
+    if fallocate is None or length <= 0:
+        return False
+    return fallocate(fp.fileno(), FALLOC_FL_KEEP_SIZE, fp.tell(), length) == 0
+
+
 def quote_url(url):
     q = urllib2.quote
     i = len('lastfm:')
     return url[:i] + q(url[i:])
 
 
-__all__ = ['quote_url', 'BackoffDelay', 'md5']
+__all__ = ['quote_url', 'BackoffDelay', 'LatestValue', 'LazyModule', 'md5',
+           'move_file', 'preallocate']
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Writing track files from a background thread.
+
+Stream servers drop clients that don't read fast enough, so a slow disk
+must not hold up socket reads. ``FileWriter`` queues received chunks and
+a ``WriterThread`` writes them. The queue is bounded: once
+``max_pending`` bytes are waiting the reader blocks (so TCP flow control
+slows the sender down) and if the disk doesn't catch up within
+``stall_timeout`` seconds the write fails and the track can be resumed
+later. A reader that can't block checks ``ready`` and stops reading the
+stream instead.
+
+A writer has its own thread unless it is given one to share, which is how
+``AsyncRadioClient`` writes all its streams from a single thread.
+'''
+
+from __future__ import with_statement
+import collections
+import sys
+import threading
+import time
+
+from lastrecorder import metrics
+
+WRITE_QUEUE_BYTES = 4 * 1024 * 1024
+WRITE_STALL_TIMEOUT = 30
+
+QUEUE_BYTES = metrics.registry.gauge(
+    'lastrecorder_write_queue_bytes',
+    'Received audio bytes waiting to be written to disk')
+STALL_SECONDS = metrics.registry.counter(
+    'lastrecorder_write_stall_seconds_total',
+    'Time stream reads waited for a full write queue')
+
+
+class WriterStalled(IOError):
+    pass
+
+
+class WriterThread(object):
+    '''Thread writing data queued by any number of ``FileWriter`` objects,
+    taking a chunk from each in turn
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.writers = []
+        self.stopped = False
+        self.thread = threading.Thread(name='writer', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, writer):
+        with self.cond:
+            self.writers.append(writer)
+
+    def stop(self):
+        '''Let the thread exit once all its writers are closed. Waits for
+        it unless it has been left a stalled write.
+        '''
+        with self.cond:
+            self.stopped = True
+            self.cond.notifyAll()
+            stalled = [ w for w in self.writers if w.abandoned ]
+        if not stalled:
+            self.thread.join()
+
+    def next_write(self):
+        '''Wait for queued data. Returns writer and data to write, writer
+        and ``None`` if its file has to be closed, or ``None`` when stopped.
+        Called with the lock held.
+        '''
+        while True:
+            for writer in self.writers[:]:
+                if writer.abandoned:
+                    if not writer.busy:
+                        # The owner has given up and left the file to us
+                        writer.drop()
+                        writer.busy = True
+                        return writer, None
+                elif writer.closed and not writer.queue:
+                    self.writers.remove(writer)
+            for i, writer in enumerate(self.writers):
+                if writer.queue:
+                    del self.writers[i]
+                    self.writers.append(writer)
+                    writer.busy = True
+                    return writer, writer.queue.popleft()
+            if self.stopped and not self.writers:
+                return None
+            self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                job = self.next_write()
+            if job is None:
+                return
+            writer, data = job
+            if data is None:
+                try:
+                    writer.fp.close()
+                except (IOError, OSError):
+                    pass
+                with self.cond:
+                    self.writers.remove(writer)
+                continue
+            error = None
+            try:
+                writer.fp.write(data)
+            except (IOError, OSError):
+                error = sys.exc_info()
+            with self.cond:
+                writer.busy = False
+                if error is not None:
+                    writer.error = error
+                    writer.drop()
+                else:
+                    writer.pending -= len(data)
+                    QUEUE_BYTES.dec(len(data))
+                self.cond.notifyAll()
+
+
+class FileWriter(object):
+    def __init__(self, fp, max_pending=WRITE_QUEUE_BYTES,
+                 stall_timeout=WRITE_STALL_TIMEOUT, thread=None):
+        self.fp = fp
+        self.max_pending = max_pending
+        self.stall_timeout = stall_timeout
+        self.queue = collections.deque()
+        self.pending = 0
+        self.error = None
+        self.closed = False
+        # Set when close() gives up waiting, queued data is dropped and
+        # the writer thread closes fp
+        self.abandoned = False
+        # Set while the writer thread writes to fp
+        self.busy = False
+        # When ready() first found the queue full
+        self.full_since = None
+        self.own_thread = thread is None
+        if self.own_thread:
+            thread = WriterThread()
+        self.thread = thread
+        self.cond = thread.cond
+        thread.add(self)
+
+    def ready(self, size):
+        '''Check without blocking if `size` bytes can be queued. Raises
+        ``WriterStalled`` if the queue has been full for ``stall_timeout``
+        seconds and error of a previous write.
+        '''
+        with self.cond:
+            self.check()
+            now = time.time()
+            if not self.pending or self.pending + size <= self.max_pending:
+                if self.full_since is not None:
+                    STALL_SECONDS.inc(now - self.full_since)
+                    self.full_since = None
+                return True
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since > self.stall_timeout:
+                STALL_SECONDS.inc(now - self.full_since)
+                self.full_since = None
+                raise WriterStalled('Disk write stalled for %d seconds' %
+                                    self.stall_timeout)
+            return False
+
+    def write(self, data):
+        '''Queue `data` for writing. Blocks while the queue is full.
+        Raises error of a previous write.
+        '''
+        # The buffer behind a view is reused by the next read
+        if isinstance(data, buffer):
+            data = data[:]
+        elif not isinstance(data, str):
+            # memoryview
+            data = data.tobytes()
+        with self.cond:
+            self.check()
+            started = None
+            while self.pending and self.pending + len(data) > self.max_pending:
+                now = time.time()
+                if started is None:
+                    started = now
+                elif now - started > self.stall_timeout:
+                    STALL_SECONDS.inc(now - started)
+                    raise WriterStalled('Disk write stalled for %d seconds' %
+                                        (now - started))
+                self.cond.wait(self.stall_timeout - (now - started))
+                self.check()
+            if started is not None:
+                STALL_SECONDS.inc(time.time() - started)
+            self.queue.append(data)
+            self.pending += len(data)
+            QUEUE_BYTES.inc(len(data))
+            self.cond.notifyAll()
+
+    def flush(self):
+        '''Wait until all queued data is written and flush the file. Raises
+        ``WriterStalled`` if nothing gets written for ``stall_timeout``
+        seconds.
+        '''
+        with self.cond:
+            started = time.time()
+            pending = self.pending
+            while self.pending and self.error is None:
+                now = time.time()
+                if self.pending < pending:
+                    started, pending = now, self.pending
+                elif now - started > self.stall_timeout:
+                    raise WriterStalled('Disk write stalled for %d seconds' %
+                                        (now - started))
+                self.cond.wait(self.stall_timeout - (now - started))
+            self.check()
+        self.fp.flush()
+
+    def close(self):
+        '''Write queued data. Data received before a failure is kept in
+        the file to resume from. Returns ``False`` if the disk stalled: the
+        file is then closed by the writer thread and must not be used.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notifyAll()
+            deadline = time.time() + self.stall_timeout
+            while (self.queue or self.busy) and self.error is None:
+                now = time.time()
+                if now >= deadline:
+                    self.abandoned = True
+                    break
+                self.cond.wait(deadline - now)
+        if self.own_thread:
+            self.thread.stop()
+        return not self.abandoned
+
+    def check(self):
+        if self.error is not None:
+            exc_type, exc_value, tb = self.error
+            raise exc_type, exc_value, tb
+
+    def drop(self):
+        QUEUE_BYTES.dec(self.pending)
+        self.queue.clear()
+        self.pending = 0
@@ -28,7 +28,7 @@ setup(
             '%s-cli = %s.main:cli_main' % (module, module),
         ],
         gui_scripts = [
-            '%s = %s.gui:gui_main' % (module, module),
+            '%s = %s.main:gui_main' % (module, module),
         ],
     ),
     data_files = [